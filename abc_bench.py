@@ -0,0 +1,280 @@
+"""
+智慧物料 ABC 分類 - 效能基準測試
+
+以固定亂數種子產生模擬 BOM 資料，分段計時（讀取、主分類、數值轉換、ABC 分析、統計、匯出）並記錄記憶體高峰：
+
+    python abc_bench.py run --sizes 10000 100000 1000000 --save-baseline bench_baseline.json
+    python abc_bench.py run --baseline bench_baseline.json        # 與基準比較，變慢超過容許值時結束代碼為 1
+    python abc_bench.py generate 100000 -o sample.xlsx            # 只產生模擬資料（可直接上傳到網頁測試）
+
+每個資料量在獨立的子行程中執行，行程記憶體高峰互不影響。
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from abc_core import (
+    DEFAULT_RULES,
+    ColumnMapping,
+    Diagnostics,
+    assign_abc_labels,
+    classify,
+    clean_numeric_column,
+    compile_rules,
+    summary_tables,
+)
+from abc_io import export_frame, read_sheet
+from abc_perf import environment_info, peak_rss_mb
+
+# --- 模擬資料 ---
+BENCH_COLUMNS = ColumnMapping("產品編號", "幣別", "需求數", "單價")
+
+# (前綴, 本體字元, 權重)：板金 4KB…P、加工件 4KB + M/H/S/L/K、KB…、電料 4KZ…、市購件 4SS…、其餘雜訊
+PART_FAMILIES = [
+    ("4KB", "0123456789P", 0.15),
+    ("4KB", "0123456789MHSLK", 0.20),
+    ("KB", "0123456789ABC", 0.10),
+    ("4KZ", "0123456789ABCDEF", 0.15),
+    ("4SS", "0123456789-", 0.15),
+    ("", "0123456789ABCDEFGHJKLMNPQRSTUVWXYZ-", 0.25),
+]
+CURRENCY_CHOICES = ["NTD", "NTD", "NTD", "ntd", " NTD ", "USD", "EUR", "JPY", "TWD", "", None, np.nan]
+MESSY_NUMBERS = ["1,200", "$3.5", "待定", "15%", "TBD", "-", "N/A", " 7 ", "￥100", "€ 20", "12pcs", "1e3", "#N/A"]
+
+def generate_part_codes(count, rng):
+    """產生 count 個相異機率的料號（部分小寫、前後空白，模擬人工輸入）"""
+    weights = np.array([family[2] for family in PART_FAMILIES])
+    families = rng.choice(len(PART_FAMILIES), size=count, p=weights / weights.sum())
+    lengths = rng.integers(4, 10, size=count)
+    codes = []
+    for family, length in zip(families, lengths):
+        prefix, alphabet, _ = PART_FAMILIES[family]
+        body = "".join(rng.choice(list(alphabet), size=length))
+        if family == 0 and "P" not in body:
+            body = body[:-1] + "P"
+        codes.append(prefix + body)
+    codes = np.array(codes, dtype=object)
+    lower = rng.random(count) < 0.05
+    codes[lower] = [code.lower() for code in codes[lower]]
+    padded = rng.random(count) < 0.03
+    codes[padded] = [f" {code} " for code in codes[padded]]
+    return codes
+
+def messy_numbers(values, rng, messy_ratio):
+    """將部分數值改為文字格式（千分位、貨幣符號、待定、百分比等）"""
+    result = values.astype(object)
+    messy = rng.random(len(values)) < messy_ratio
+    formatted = rng.random(len(values)) < 0.5
+    # 一半改為帶格式的數字字串，一半改為常見的雜訊文字
+    with_format = messy & formatted
+    result[with_format] = [f"{value:,.1f}" if value >= 1000 else f"${value}" for value in values[with_format]]
+    noise = messy & ~formatted
+    result[noise] = rng.choice(np.array(MESSY_NUMBERS, dtype=object), size=int(noise.sum()))
+    return result
+
+def generate_bom(rows, seed=0, distinct_parts=None, messy_ratio=0.1):
+    """
+    產生模擬 BOM 資料，欄位順序與網頁預設的欄位對應相同：序號、產品編號、品名、需求數、單價、幣別
+    distinct_parts：相異料號數（預設為列數的 1/20，同一料號重複出現在多列）
+    """
+    rng = np.random.default_rng(seed)
+    distinct_parts = distinct_parts or max(1, rows // 20)
+    parts = generate_part_codes(distinct_parts, rng)
+    codes = parts[rng.integers(0, distinct_parts, size=rows)]
+    codes[rng.random(rows) < 0.01] = None
+
+    quantities = rng.integers(1, 500, size=rows).astype(float)
+    prices = np.round(rng.lognormal(3, 1.5, size=rows), 2)
+    prices[rng.random(rows) < 0.05] = 0
+    currencies = np.array(CURRENCY_CHOICES, dtype=object)[rng.integers(0, len(CURRENCY_CHOICES), size=rows)]
+
+    return pd.DataFrame({
+        "序號": np.arange(1, rows + 1),
+        "產品編號": codes,
+        "品名": "BOM-" + pd.Series(rng.integers(0, 1000, size=rows)).astype(str),
+        "需求數": messy_numbers(quantities, rng, messy_ratio),
+        "單價": messy_numbers(prices, rng, messy_ratio),
+        "幣別": currencies,
+    })
+
+def write_dataset(frame, path):
+    if path.suffix == ".csv":
+        frame.to_csv(path, index=False, encoding="utf-8-sig")
+    else:
+        export_frame(frame, "xlsx", target=str(path))
+
+def load_dataset(path):
+    if path.suffix == ".csv":
+        return pd.read_csv(path)
+    return read_sheet(str(path), 0)
+
+# --- 計時 ---
+class StageTimer:
+    """分段計時：記錄每段的秒數與行程記憶體高峰；trace_memory 時另以 tracemalloc 記錄該段配置的記憶體高峰"""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def run(self, name, func, *args):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        stage = {"seconds": seconds, "peak_rss_mb": peak_rss_mb()}
+        if self.trace_memory:
+            stage["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+        previous = self.stages.get(name)
+        # 重複執行時保留最快的一次
+        if previous is None or seconds < previous["seconds"]:
+            self.stages[name] = stage
+        return result
+
+def abc_stage(frame, quantities, prices):
+    """ABC 分析：計算金額並在各分類內依金額累計（對應 abc() 中數值清理之後的部分）"""
+    frame['需求數_清理'] = quantities
+    frame['單價_清理'] = prices
+    frame['金額'] = frame['需求數_清理'] * frame['單價_清理']
+    frame['累計金額'], frame['累計百分比'], frame['ABC類別'] = assign_abc_labels(frame['分類'], frame['金額'])
+    return frame
+
+def benchmark_size(rows, data_path, rules, repeat, export_format, trace_memory):
+    """在子行程中對單一資料量執行所有階段，回傳 {階段: 計時結果}"""
+    timer = StageTimer(trace_memory)
+    compiled = compile_rules(rules)
+    for _ in range(repeat):
+        frame = timer.run("load", load_dataset, data_path)
+        frame = timer.run("classify", classify, frame, compiled, BENCH_COLUMNS, Diagnostics())
+        quantities, _ = timer.run("clean_quantity", clean_numeric_column, frame[BENCH_COLUMNS.qty_col])
+        prices, _ = timer.run("clean_price", clean_numeric_column, frame[BENCH_COLUMNS.price_col])
+        frame = timer.run("abc", abc_stage, frame, quantities, prices)
+        tables = timer.run("stats", summary_tables, frame)
+        extra_sheets = {name: table for name, table in tables.items() if name != "分類結果"}
+        timer.run("export", export_frame, frame, export_format, extra_sheets if export_format == "xlsx" else None)
+        del frame, tables
+    return timer.stages
+
+# --- 報表 ---
+# 差距小於此秒數時不視為退步（避免極短階段的計時誤差）
+MIN_REGRESSION_SECONDS = 0.05
+
+def display_width(text):
+    return sum(2 if unicodedata.east_asian_width(char) in "WF" else 1 for char in text)
+
+def pad(text, width, right=False):
+    """依顯示寬度補空白（中文字佔兩格）"""
+    spaces = " " * max(0, width - display_width(text))
+    return spaces + text if right else text + spaces
+
+def format_report(results, baseline=None, tolerance=0.2):
+    """輸出各階段計時表；有基準時加上比值，變慢超過 tolerance 的項目標記並回傳"""
+    lines = []
+    regressions = []
+    trace_memory = any("traced_peak_mb" in result for stages in results.values() for result in stages.values())
+    for size, stages in results.items():
+        lines.append(f"\n{int(size):,} 筆")
+        header = pad("階段", 16) + pad("秒數", 10, True) + pad("RSS高峰(MB)", 14, True)
+        if trace_memory:
+            header += pad("配置高峰(MB)", 14, True)
+        lines.append("  " + header + pad("基準比", 12, True))
+        for stage, result in stages.items():
+            ratio = ""
+            reference = (baseline or {}).get(size, {}).get(stage)
+            if reference and reference["seconds"] > 0:
+                value = result["seconds"] / reference["seconds"]
+                ratio = f"{value:.2f}x"
+                if value > 1 + tolerance and result["seconds"] - reference["seconds"] > MIN_REGRESSION_SECONDS:
+                    ratio += " ⚠"
+                    regressions.append((size, stage, value))
+            line = pad(stage, 16) + pad(f"{result['seconds']:.3f}", 10, True) + pad(f"{result['peak_rss_mb']:.1f}", 14, True)
+            if trace_memory:
+                line += pad(f"{result.get('traced_peak_mb', 0):.1f}", 14, True)
+            lines.append("  " + line + pad(ratio, 12, True))
+    return "\n".join(lines), regressions
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="智慧物料 ABC 分類 - 效能基準測試")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="執行基準測試")
+    run.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="測試的資料筆數")
+    run.add_argument("--repeat", type=int, default=1, help="每個資料量重複次數（各階段取最快一次）")
+    run.add_argument("--seed", type=int, default=0, help="模擬資料的亂數種子")
+    run.add_argument("--input-format", choices=["xlsx", "csv"], default="xlsx", help="讀取階段使用的檔案格式")
+    run.add_argument("--export-format", choices=["xlsx", "csv", "parquet"], default="xlsx", help="匯出階段的格式")
+    run.add_argument("--rules", help="規則設定 JSON，預設使用系統預設規則")
+    run.add_argument("--data-dir", default=str(Path(tempfile.gettempdir()) / "abc_bench"), help="模擬資料檔存放位置（相同參數會重複使用）")
+    run.add_argument("--trace-memory", action="store_true", help="以 tracemalloc 記錄每段 Python/numpy 配置的高峰（會明顯變慢）")
+    run.add_argument("--baseline", help="與此基準結果（JSON）比較")
+    run.add_argument("--tolerance", type=float, default=0.2, help="比基準慢超過此比例視為退步（預設 0.2 = 20%%）")
+    run.add_argument("--save-baseline", help="將本次結果存為基準（JSON）")
+
+    generate = commands.add_parser("generate", help="只產生模擬資料檔")
+    generate.add_argument("rows", type=int, help="資料筆數")
+    generate.add_argument("-o", "--output", required=True, help="輸出檔案（.xlsx 或 .csv）")
+    generate.add_argument("--seed", type=int, default=0, help="亂數種子")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.command == "generate":
+        write_dataset(generate_bom(args.rows, args.seed), Path(args.output))
+        print(f"已產生 {args.rows:,} 筆模擬資料：{args.output}")
+        return 0
+
+    rules = DEFAULT_RULES
+    if args.rules:
+        with open(args.rules, encoding="utf-8") as f:
+            rules = json.load(f)
+
+    data_dir = Path(args.data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    results = {}
+    for rows in args.sizes:
+        data_path = data_dir / f"bom_{rows}_{args.seed}.{args.input_format}"
+        if not data_path.exists():
+            print(f"產生 {rows:,} 筆模擬資料 → {data_path}")
+            write_dataset(generate_bom(rows, args.seed), data_path)
+        # 每個資料量使用全新的子行程，記憶體高峰只反映該資料量
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+            results[str(rows)] = pool.submit(
+                benchmark_size, rows, data_path, rules, args.repeat, args.export_format, args.trace_memory
+            ).result()
+        print(f"完成 {rows:,} 筆")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            saved = json.load(f)
+        baseline = saved["results"]
+        for option in ("input_format", "export_format", "rules", "seed"):
+            if saved["args"].get(option) != getattr(args, option):
+                print(f"⚠ 基準的 {option} 為 {saved['args'].get(option)!r}，與本次 {getattr(args, option)!r} 不同，比值僅供參考")
+    report, regressions = format_report(results, baseline, args.tolerance)
+    print(report)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"environment": environment_info(), "args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\n基準結果已儲存：{args.save_baseline}")
+
+    if regressions:
+        print(f"\n⚠ 有 {len(regressions)} 個階段比基準慢超過 {args.tolerance:.0%}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""
+分類結果與工作表快照的磁碟快取
+
+以（快取版本、檔案內容雜湊、規則、工作表、欄位對應、讀取欄位、ABC 門檻）為鍵，將分類結果與統計表存成 Parquet，
+跨工作階段與程式重啟共用；總容量超過上限時，依最近使用時間淘汰最舊的結果。
+解析後的工作表另以（檔案內容雜湊、工作表）為鍵存成 Parquet 快照，再次讀取時以記憶體對應只讀取需要的欄位。
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from abc_core import ABC_THRESHOLDS, Diagnostics
+from abc_io import HAS_PARQUET, as_text_column, is_csv, read_columns, read_header, read_sheet
+
+DEFAULT_CACHE_DIR = Path(os.environ.get("ABC_CACHE_DIR", Path.home() / ".cache" / "abc_classifier"))
+DEFAULT_CACHE_MAX_BYTES = int(float(os.environ.get("ABC_CACHE_MAX_MB", 1024)) * 1024 * 1024)
+DEFAULT_SHEET_CACHE_DIR = Path(os.environ.get("ABC_SHEET_CACHE_DIR", Path.home() / ".cache" / "abc_classifier_sheets"))
+DEFAULT_SHEET_CACHE_MAX_BYTES = int(float(os.environ.get("ABC_SHEET_CACHE_MAX_MB", 2048)) * 1024 * 1024)
+
+# 結果快取的格式版本：分類、ABC 計算或輸出欄位的語意改變時遞增，舊版本的結果不再命中
+CACHE_VERSION = 2
+
+def rules_hash(rules):
+    """規則的正規化雜湊：鍵順序不同但內容相同的規則得到相同結果"""
+    canonical = json.dumps(rules, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def result_cache_key(file_hash, rules, sheet_name, columns, usecols=None, thresholds=ABC_THRESHOLDS):
+    """結果快取鍵；usecols 為快速讀取時實際讀取的欄位（完整讀取為 None）"""
+    parts = {
+        "version": CACHE_VERSION,
+        "file": file_hash,
+        "rules": rules_hash(rules),
+        "sheet": sheet_name,
+        "columns": [columns.prod_col, columns.currency_col, columns.qty_col, columns.price_col],
+        "usecols": None if usecols is None else list(usecols),
+        "thresholds": list(thresholds),
+    }
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+def split_arrow_columns(frame):
+    """分出 Arrow 無法表示的欄位（如同時有數字與文字的原始欄位），這些欄位另以 pickle 保存"""
+    import pyarrow as pa
+
+    plain, others = [], []
+    for position in range(frame.shape[1]):
+        try:
+            pa.array(frame.iloc[:, position], from_pandas=True)
+            plain.append(position)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            others.append(position)
+    return plain, others
+
+def sheet_cache_key(file_hash, sheet_name):
+    """工作表快照的快取鍵"""
+    return hashlib.sha256(json.dumps([file_hash, sheet_name], ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+def as_text_columns(frame, text_cols):
+    """把完整讀取結果中的 text_cols 轉為與快速讀取相同的字串"""
+    for name in text_cols:
+        if name in frame.columns:
+            frame[name] = as_text_column(frame[name])
+    return frame
+
+def write_table(frame, path):
+    """以 Parquet 保存 DataFrame（含索引與欄位名稱），無法轉換的欄位存到同名 .pkl"""
+    plain, others = split_arrow_columns(frame)
+    frame.iloc[:, plain].to_parquet(path.with_suffix(".parquet"))
+    if others:
+        with open(path.with_suffix(".pkl"), "wb") as f:
+            pickle.dump((list(frame.columns), others, frame.iloc[:, others]), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def read_table(path):
+    frame = pd.read_parquet(path.with_suffix(".parquet"))
+    extra_path = path.with_suffix(".pkl")
+    if extra_path.exists():
+        with open(extra_path, "rb") as f:
+            all_columns, others, extra = pickle.load(f)
+        for offset, position in enumerate(others):
+            frame.insert(position, all_columns[position], extra.iloc[:, offset], allow_duplicates=True)
+    return frame
+
+class DiskCache:
+    """每個鍵一個目錄的磁碟快取：讀取時更新目錄時間作為最近使用時間，寫入後淘汰超過 max_bytes 的最舊項目"""
+
+    def __init__(self, directory, max_bytes):
+        if not HAS_PARQUET:
+            raise RuntimeError("磁碟快取需要 pyarrow")
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def touch(self, entry):
+        now = time.time()
+        os.utime(entry, (now, now))
+
+    def commit(self, key, write):
+        """write(暫存目錄) 寫出內容後改名為 key，寫到一半的內容不會被讀到"""
+        entry = self.directory / key
+        staging = Path(tempfile.mkdtemp(prefix=".staging-", dir=self.directory))
+        try:
+            write(staging)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(staging, entry)
+        except OSError:
+            # 另一個工作階段同時寫入相同鍵，或磁碟空間不足：略過快取
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        self.evict()
+
+    def entries(self):
+        """回傳 [(最近使用時間, 大小, 路徑)]，最舊的在前"""
+        result = []
+        for entry in self.directory.iterdir():
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+            size = sum(f.stat().st_size for f in entry.iterdir())
+            result.append((entry.stat().st_mtime, size, entry))
+        return sorted(result)
+
+    def evict(self):
+        """依最近使用時間淘汰，直到總容量不超過上限（最新的一筆永遠保留）"""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+class ResultCache(DiskCache):
+    """磁碟上的分類結果快取：每個鍵一個目錄，內含各資料表（Parquet）與 meta.json（提示訊息、數值統計）"""
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        super().__init__(directory, max_bytes)
+
+    def get(self, key):
+        """回傳 (資料表 dict, Diagnostics)；沒有快取或快取損壞時回傳 None"""
+        entry = self.directory / key
+        try:
+            with open(entry / "meta.json", encoding="utf-8") as f:
+                meta = json.load(f)
+            tables = {name: read_table(entry / f"table_{index}") for index, name in enumerate(meta["tables"])}
+        except (OSError, ValueError, KeyError, pickle.UnpicklingError):
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        self.touch(entry)
+        return tables, Diagnostics(meta["warnings"], meta["numeric_stats"])
+
+    def put(self, key, tables, diagnostics):
+        """保存資料表（{名稱: DataFrame}）"""
+        def write(staging):
+            for index, frame in enumerate(tables.values()):
+                write_table(frame, staging / f"table_{index}")
+            meta = {
+                "tables": list(tables),
+                "warnings": diagnostics.warnings,
+                "numeric_stats": diagnostics.numeric_stats,
+            }
+            with open(staging / "meta.json", "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+
+        self.commit(key, write)
+
+class SheetCache(DiskCache):
+    """
+    工作表快照：每個 (檔案內容雜湊, 工作表) 一個目錄，內含完整讀取結果（Parquet）與 header.pkl（原始欄位名稱）
+    Parquet 內的欄位以位置命名，欄位名稱不是字串（如數字標題）的工作表也能保存
+    """
+
+    def __init__(self, directory=DEFAULT_SHEET_CACHE_DIR, max_bytes=DEFAULT_SHEET_CACHE_MAX_BYTES):
+        super().__init__(directory, max_bytes)
+
+    def header(self, key):
+        """快照的欄位名稱；沒有快照時回傳 None"""
+        try:
+            with open(self.directory / key / "header.pkl", "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def get(self, key, usecols=None, text_cols=()):
+        """
+        讀取快照（以記憶體對應讀取 Parquet，usecols 指定時只讀取這些欄位並依 usecols 的順序排列）
+        text_cols 轉為與快速讀取相同的字串；沒有快照或快照損壞時回傳 None
+        """
+        entry = self.directory / key
+        header = self.header(key)
+        if header is None:
+            return None
+        if usecols is not None and any(name not in header for name in usecols):
+            return None  # 快照沒有這些欄位：交給呼叫端直接讀取（由 read_columns 回報找不到的欄位）
+        positions = range(len(header)) if usecols is None else [header.index(name) for name in usecols]
+        names = [str(position) for position in positions]
+        try:
+            extra = None
+            if (entry / "sheet.pkl").exists():
+                # Arrow 無法表示的欄位（型別混雜）另存於 pickle
+                with open(entry / "sheet.pkl", "rb") as f:
+                    _, _, extra = pickle.load(f)
+            plain = [name for name in names if extra is None or name not in extra.columns]
+            frame = pd.read_parquet(entry / "sheet.parquet", columns=plain, memory_map=True)
+            if extra is not None:
+                frame = pd.concat([frame, extra[[name for name in names if name in extra.columns]]], axis=1)
+        except (OSError, ValueError, KeyError, pickle.UnpicklingError):
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        self.touch(entry)
+        return as_text_columns(frame[names].set_axis([header[position] for position in positions], axis=1), text_cols)
+
+    def put(self, key, frame):
+        """保存完整讀取的工作表"""
+        def write(staging):
+            write_table(frame.set_axis([str(position) for position in range(frame.shape[1])], axis=1), staging / "sheet")
+            with open(staging / "header.pkl", "wb") as f:
+                pickle.dump(list(frame.columns), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.commit(key, write)
+
+def get_sheet_cache():
+    """預設的工作表快照快取；未安裝 pyarrow 或快取目錄無法寫入時回傳 None"""
+    try:
+        return SheetCache()
+    except (RuntimeError, OSError):
+        return None
+
+def read_sheet_cached(cache, file_hash, source, sheet_name):
+    """完整讀取工作表：有快照時直接讀取快照，否則解析後建立快照（CSV 與停用快取時直接讀取）"""
+    if cache is None or is_csv(source):
+        return read_sheet(source, sheet_name)
+    key = sheet_cache_key(file_hash, sheet_name)
+    frame = cache.get(key)
+    if frame is None:
+        frame = read_sheet(source, sheet_name)
+        cache.put(key, frame)
+    return frame
+
+def read_header_cached(cache, file_hash, source, sheet_name):
+    """只讀取標題列；有快照時使用快照的欄位名稱"""
+    header = None if cache is None or is_csv(source) else cache.header(sheet_cache_key(file_hash, sheet_name))
+    return read_header(source, sheet_name) if header is None else header
+
+def read_columns_cached(cache, file_hash, source, sheet_name, usecols, text_cols=()):
+    """
+    快速讀取：有快照（先前完整讀取時建立）時只從快照讀取 usecols，否則以 read_columns 串流讀取這些欄位
+    沒有快照時不另外建立，維持只讀取部分欄位的記憶體用量；結果皆與 read_columns 相同
+    """
+    frame = None
+    if cache is not None and not is_csv(source):
+        frame = cache.get(sheet_cache_key(file_hash, sheet_name), usecols, text_cols)
+    return read_columns(source, sheet_name, usecols, text_cols) if frame is None else frame
@@ -1,8 +1,57 @@
 import pandas as pd
 import streamlit as st
-import io
 import json
 import hashlib
+from contextlib import nullcontext
+
+from abc_core import (
+    ABC_THRESHOLDS,
+    DEFAULT_RULES,
+    FIXED_CATEGORIES,
+    RESERVED_CATEGORIES,
+    SCENARIO_BASES,
+    ClassificationMemo,
+    ColumnMapping,
+    Diagnostics,
+    IncrementalAnalysis,
+    ResultView,
+    RuleTrace,
+    abc,
+    abc_scenarios,
+    check_rule,
+    classify,
+    clean_code_list,
+    compact_result,
+    compile_rules,
+    default_sheet_index_for,
+    expand_result,
+    find_rule_problems,
+    footprint_mb,
+    parse_test_codes,
+    parse_threshold_pairs,
+    rule_coverage,
+    scenario_matrix,
+    summary_tables,
+)
+from abc_cache import (
+    ResultCache,
+    get_sheet_cache,
+    read_columns_cached,
+    read_header_cached,
+    read_sheet_cached,
+    result_cache_key,
+)
+from abc_io import (
+    EXPORT_FORMATS,
+    available_export_formats,
+    content_hash,
+    export_frame,
+    list_sheet_names,
+)
+from abc_parallel import abc_parallel, classify_parallel, default_workers
+from abc_perf import RunProfiler, environment_info, profile_engines
+
+st.set_page_config(page_title="智慧物料分類工具", layout="wide")
 
 # 安全設定 - 使用 Streamlit Secrets (適用於 Streamlit Cloud 部署)
 try:
@@ -81,47 +130,92 @@ if not check_password():
 def load_default_rules():
     return DEFAULT_RULES.copy()
 
-@st.cache_data
-def process_excel_file(file_data, sheet_name):
-    return pd.read_excel(io.BytesIO(file_data), sheet_name=sheet_name)
-
-# --- 預設分類規則 ---
-DEFAULT_RULES = {
-    "進口": {
-        "condition_type": "currency",
-        "rule": "not_ntd",
-        "description": "幣別不是NTD的項目"
-    },
-    "板金": {
-        "condition_type": "product_code",
-        "rule": "startswith_4KB_and_contains_P",
-        "description": "產品編號以4KB開頭且包含P"
-    },
-    "加工件": {
-        "condition_type": "product_code", 
-        "rule": "startswith_4KB_contains_MHSLK_or_startswith_kb",
-        "description": "產品編號以4KB開頭包含M/H/S/L/K，或以KB開頭"
-    },
-    "電料": {
-        "condition_type": "product_code",
-        "rule": "startswith_4KZ", 
-        "description": "產品編號以4KZ開頭"
-    },
-    "市購件": {
-        "condition_type": "product_code",
-        "rule": "startswith_4SS",
-        "description": "產品編號以4SS開頭"
-    }
-}
+def upload_content_hash(uploaded_file):
+    """上傳檔案的內容雜湊，同一次上傳只計算一次"""
+    file_id = getattr(uploaded_file, "file_id", None)
+    hashes = st.session_state.setdefault("upload_hashes", {})
+    if file_id is None or file_id not in hashes:
+        digest = content_hash(uploaded_file.getvalue())
+        if file_id is None:
+            return digest
+        hashes[file_id] = digest
+    return hashes[file_id]
+
+@st.cache_data(show_spinner=False)
+def list_workbook_sheets(file_hash, _file_bytes):
+    """依內容雜湊快取工作表清單（只讀取活頁簿中繼資料）"""
+    return list_sheet_names(_file_bytes)
+
+@st.cache_resource(show_spinner="正在讀取工作表...", max_entries=16)
+def load_workbook_sheet(file_hash, sheet_name, _file_bytes):
+    """
+    依 (內容雜湊, 工作表) 快取解析結果，每次上傳的每個工作表最多解析一次；
+    解析結果另存為磁碟上的 Parquet 快照，重新啟動或再次上傳相同檔案時直接讀取快照
+    回傳的 DataFrame 由所有重新執行共用，使用端不可直接修改（需先 copy）
+    """
+    return read_sheet_cached(get_sheet_cache(), file_hash, _file_bytes, sheet_name)
+
+@st.cache_data(show_spinner=False)
+def load_sheet_header(file_hash, sheet_name, _file_bytes):
+    """快速讀取模式：只讀取標題列（有快照時使用快照的欄位名稱）"""
+    return read_header_cached(get_sheet_cache(), file_hash, _file_bytes, sheet_name)
+
+@st.cache_resource(show_spinner="正在讀取所選欄位...", max_entries=16)
+def load_sheet_columns(file_hash, sheet_name, usecols, text_cols, _file_bytes):
+    """快速讀取模式：只讀取對應欄位，產品編號與幣別讀為字串（使用端不可直接修改）；有快照時只從快照讀取這些欄位"""
+    return read_columns_cached(get_sheet_cache(), file_hash, _file_bytes, sheet_name, list(usecols), text_cols)
+
+@st.cache_resource
+def get_result_cache():
+    """跨工作階段與重啟共用的分類結果快取；未安裝 pyarrow 或快取目錄無法寫入時停用"""
+    try:
+        return ResultCache()
+    except (RuntimeError, OSError):
+        return None
+
+def load_cached_result(result_key):
+    """依序查詢本工作階段最後一次的結果與磁碟快取，回傳 (資料表 dict, Diagnostics) 或 None"""
+    last_result = st.session_state.get("last_result")
+    if last_result is not None and last_result[0] == result_key:
+        return last_result[1]
+    result_cache = get_result_cache()
+    cached = result_cache.get(result_key) if result_cache is not None else None
+    if cached is not None:
+        st.session_state.last_result = (result_key, cached)
+    return cached
+
+def store_result(result_key, tables, diagnostics):
+    """保存結果：本工作階段保留最後一次（下載等重新執行後仍可顯示），並寫入磁碟快取"""
+    st.session_state.last_result = (result_key, (tables, diagnostics))
+    result_cache = get_result_cache()
+    if result_cache is not None:
+        result_cache.put(result_key, tables, diagnostics)
 
 # --- 動態規則建立器 ---
+def code_lists_input(key):
+    """編碼清單輸入（每行或以逗號分隔一個字串），回傳 code_lists 規則；皆未輸入時回傳 None"""
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        prefixes = clean_code_list(st.text_area("開頭（任一）：", key=f"code_prefixes_{key}", placeholder="4KB\n4KZ"))
+    with col2:
+        suffixes = clean_code_list(st.text_area("結尾（任一）：", key=f"code_suffixes_{key}", placeholder="-P\n_M"))
+    with col3:
+        contains = clean_code_list(st.text_area("包含（任一）：", key=f"code_contains_{key}", placeholder="MOTOR\nPCB"))
+    if not (prefixes or suffixes or contains):
+        return None
+    parts = [f"{label} {', '.join(values)}" for label, values in (("開頭", prefixes), ("結尾", suffixes), ("包含", contains)) if values]
+    return {
+        "condition_type": "code_lists",
+        "prefixes": list(prefixes),
+        "suffixes": list(suffixes),
+        "contains": list(contains),
+        "description": "產品編號" + "，或".join(parts),
+    }
+
 def create_custom_rules():
     """讓使用者自訂五大分類的編碼規則"""
     st.subheader(" 五大分類規則設定")
     
-    # 固定的五大分類
-    FIXED_CATEGORIES = ["進口", "板金", "加工件", "電料", "市購件"]
-    
     if 'custom_rules' not in st.session_state:
         st.session_state.custom_rules = DEFAULT_RULES.copy()
     
@@ -159,7 +253,7 @@ def create_custom_rules():
                     # 產品編號規則設定
                     rule_type = st.selectbox(
                         f"{category} 的編碼規則：",
-                        ["開頭包含", "結尾包含", "包含字串", "不包含", "複合條件"],
+                        ["開頭包含", "結尾包含", "包含字串", "不包含", "複合條件", "編碼清單"],
                         key=f"rule_type_{category}"
                     )
                     
@@ -251,6 +345,11 @@ def create_custom_rules():
                                 "description": f"產品編號開頭 '{prefix_condition}' {logic} 包含 '{contains_condition}'"
                             }
                 
+                    elif rule_type == "編碼清單":
+                        code_lists_rule = code_lists_input(category)
+                        if code_lists_rule:
+                            st.session_state.custom_rules[category] = code_lists_rule
+                
                 elif condition_type == "currency":
                     # 幣別規則設定
                     currency_rule = st.selectbox(
@@ -297,6 +396,29 @@ def create_custom_rules():
                 
                 st.divider()
     
+        # 五大分類之外的自訂分類（依新增順序排在市購件之後判斷）
+        with st.expander(" 其他自訂分類（編碼清單）", expanded=False):
+            extra_categories = [c for c in st.session_state.custom_rules if c not in FIXED_CATEGORIES]
+            for category in extra_categories:
+                col1, col2 = st.columns([4, 1])
+                with col1:
+                    st.write(f"**{category}**: {st.session_state.custom_rules[category].get('description', '')}")
+                with col2:
+                    if st.button("刪除", key=f"delete_category_{category}"):
+                        del st.session_state.custom_rules[category]
+                        st.rerun()
+
+            new_category = st.text_input("新分類名稱：", key="new_category_name", placeholder="例如：氣壓元件")
+            code_lists_rule = code_lists_input("new_category")
+            if st.button("新增分類"):
+                if not new_category or new_category in st.session_state.custom_rules or new_category in RESERVED_CATEGORIES:
+                    st.error("請輸入尚未使用的分類名稱（不可為「其他」或「錯誤」）")
+                elif not code_lists_rule:
+                    st.error("請至少輸入一個開頭、結尾或包含字串")
+                else:
+                    st.session_state.custom_rules[new_category] = code_lists_rule
+                    st.rerun()
+
         # 新增：規則管理功能
         st.subheader(" 規則管理")
         col1, col2 = st.columns(2)
@@ -329,15 +451,7 @@ def validate_rules(rules):
     """驗證規則設定的完整性"""
     st.subheader("規則驗證")
     
-    FIXED_CATEGORIES = ["進口", "板金", "加工件", "電料", "市購件"]
-    missing_rules = []
-    incomplete_rules = []
-    
-    for category in FIXED_CATEGORIES:
-        if category not in rules:
-            missing_rules.append(category)
-        elif not rules[category].get("rule") or rules[category]["rule"] == "custom":
-            incomplete_rules.append(category)
+    missing_rules, incomplete_rules = find_rule_problems(rules)
     
     if missing_rules:
         st.error(f"以下分類尚未設定規則：{', '.join(missing_rules)}")
@@ -358,6 +472,11 @@ def test_rules(rules):
     st.subheader("規則測試")
     
     with st.expander("測試兩階段分類邏輯", expanded=False):
+        test_mode = st.radio("測試方式：", ["單筆測試", "批次測試（貼上清單或上傳檔案）"], horizontal=True)
+        if test_mode != "單筆測試":
+            bulk_test_rules(rules)
+            return
+
         col1, col2 = st.columns(2)
         
         with col1:
@@ -369,32 +488,33 @@ def test_rules(rules):
                 st.write(f"**測試產品**：{test_prod_code} / {test_currency}")
                 st.write("---")
                 
-                # 使用與實際分類相同的兩階段邏輯
+                # 使用與實際分類相同的兩階段邏輯（同一份已編譯規則）
+                compiled_rules = compile_rules(rules)
                 result_category = "其他"
                 
                 # 第一階段：檢查進口
                 st.write("**第一階段：檢查進口**")
                 if "進口" in rules:
-                    import_result = check_rule(test_prod_code, test_currency, rules["進口"])
+                    import_result = check_rule(test_prod_code, test_currency, compiled_rules["進口"])
                     if import_result:
                         st.success("符合進口條件 → **分類：進口**")
                         result_category = "進口"
                     else:
                         st.info("❌ 不符合進口條件 → 繼續檢查國產品分類")
                         
-                        # 第二階段：檢查國產品分類
+                        # 第二階段：檢查國產品分類（含自訂分類，依優先順序）
                         st.write("**第二階段：檢查國產品分類**")
-                        domestic_categories = ["板金", "加工件", "電料", "市購件"]
+                        domestic_categories = [c for c, _ in compiled_rules if c != "進口"]
                         
                         for category in domestic_categories:
                             if category in rules:
-                                result = check_rule(test_prod_code, test_currency, rules[category])
+                                result = check_rule(test_prod_code, test_currency, compiled_rules[category])
                                 status = "✅ 符合" if result else "❌ 不符合"
                                 st.write(f"- **{category}**: {status}")
                                 st.write(f"  └─ 規則：{rules[category]['description']}")
                                 
                                 # 顯示板金的詳細檢查
-                                if category == "板金" and rules[category]["rule"] == "startswith_4KB_and_contains_P":
+                                if category == "板金" and rules[category].get("rule") == "startswith_4KB_and_contains_P":
                                     condition1 = test_prod_code.startswith("4KB")
                                     condition2 = "P" in test_prod_code
                                     st.write(f"    - 以4KB開頭: {condition1}")
@@ -402,7 +522,7 @@ def test_rules(rules):
                                     st.write(f"    - 最終結果: {condition1 and condition2}")
                                 
                                 # 顯示加工件的詳細檢查
-                                if category == "加工件" and rules[category]["rule"] == "startswith_4KB_contains_MHSLK_or_startswith_kb":
+                                if category == "加工件" and rules[category].get("rule") == "startswith_4KB_contains_MHSLK_or_startswith_kb":
                                     condition1 = test_prod_code.startswith("4KB") and any(char in test_prod_code for char in "MHSLK")
                                     condition2 = test_prod_code.startswith("KB") and not test_prod_code.startswith("4KB")
                                     st.write(f"    - 4KB開頭且包含M/H/S/L/K: {condition1}")
@@ -419,271 +539,121 @@ def test_rules(rules):
                     st.success(f"**最終分類結果：{result_category}**")
                 else:
                     st.warning("**最終分類結果：其他**")
-# --- 更新的規則檢查函式 ---
-def check_rule(prod_code, currency, rule_info):
-    """檢查單一規則是否符合 - 支援自訂編碼規則"""
-    condition_type = rule_info["condition_type"]
-    rule = rule_info["rule"]
-    
-    if condition_type == "currency":
-        if rule == "not_ntd":
-            return currency != "NTD" and currency != "NAN" and currency != ""
-        elif rule.startswith("equals_"):
-            target_currency = rule.replace("equals_", "")
-            return currency == target_currency.upper()
-        elif rule.startswith("not_equals_"):
-            target_currency = rule.replace("not_equals_", "")
-            return currency != target_currency.upper()
-        elif rule.startswith("in_list_"):
-            currency_list = rule.replace("in_list_", "").split(",")
-            return currency in [c.upper() for c in currency_list]
-        elif rule.startswith("not_in_list_"):
-            currency_list = rule.replace("not_in_list_", "").split(",")
-            return currency not in [c.upper() for c in currency_list]
-    
-    elif condition_type == "product_code":
-        # 統一轉換為大寫處理
-        prod_code_upper = str(prod_code).upper()
-        
-        # 板金規則：4KB開頭 + 任一位置含P
-        if rule == "startswith_4KB_and_contains_P":
-            starts_with_4KB = prod_code_upper.startswith("4KB")
-            contains_P = "P" in prod_code_upper
-            result = starts_with_4KB and contains_P
-            
-            if hasattr(st.session_state, 'debug_mode') and st.session_state.debug_mode:
-                st.write(f"     板金規則詳細檢查：")
-                st.write(f"      - 產品編號：`{prod_code}`")
-                st.write(f"      - 以4KB開頭：{starts_with_4KB}")
-                st.write(f"      - 包含字母P：{contains_P}")
-                st.write(f"      - 最終結果：{result}")
-            
-            return result
-            
-        # 加工件規則：4KB開頭加特殊字元，或純KB開頭
-        elif rule == "startswith_4KB_contains_MHSLK_or_startswith_kb":
-            text = str(prod_code).upper()  # 轉為大寫處理
-            
-            # 條件1：4KB開頭 + 特殊字元
-            if text.startswith("4KB"):
-                special_chars = "MHSLK"
-                return any(char in text for char in special_chars)
-            
-            # 條件2：KB開頭（但非4KB）
-            if text.startswith("KB") and not text.startswith("4KB"):
-                return True
-            
-            return False
-        elif rule == "startswith_4KZ":
-           return prod_code.upper().startswith("4KZ")
-        elif rule == "startswith_4SS":
-           return prod_code.upper().startswith("4SS")
-        elif rule.startswith("startswith_"):
-            prefix = rule.replace("startswith_", "").upper()
-            return prod_code_upper.startswith(prefix)
-        elif rule.startswith("endswith_"):
-            suffix = rule.replace("endswith_", "").upper()
-            return prod_code_upper.endswith(suffix)
-        elif rule.startswith("contains_"):
-            substring = rule.replace("contains_", "").upper()
-            return substring in prod_code_upper
-        elif rule.startswith("not_contains_"):
-            substring = rule.replace("not_contains_", "").upper()
-            return substring not in prod_code_upper
-        elif rule.startswith("compound_"):
-            # 處理複合條件：compound_AND/OR_prefix_contains_[type]
-            parts = rule.split("_")
-            if len(parts) >= 5:
-                logic = parts[1].upper()  # AND 或 OR
-                prefix_condition = parts[2].upper()
-                contains_condition = parts[3].upper()
-                match_type = parts[4].lower() if len(parts) > 4 else "string"
-                
-                prefix_match = prod_code_upper.startswith(prefix_condition)
-                
-                # 根據匹配類型決定包含邏輯
-                if match_type == "anychar":
-                    # 檢查是否包含任一字元
-                    contains_match = any(char in prod_code_upper for char in contains_condition)
-                else:
-                    # 完整字串匹配
-                    contains_match = contains_condition in prod_code_upper
-                
-                if logic == "AND":
-                    return prefix_match and contains_match
-                elif logic == "OR":
-                    return prefix_match or contains_match
-            
-            # 兼容舊格式（沒有 match_type 的規則）
-            elif len(parts) >= 4:
-                logic = parts[1].upper()
-                prefix_condition = parts[2].upper()
-                contains_condition = parts[3].upper()
-                
-                prefix_match = prod_code_upper.startswith(prefix_condition)
-                contains_match = contains_condition in prod_code_upper
-                
-                if logic == "AND":
-                    return prefix_match and contains_match
-                elif logic == "OR":
-                    return prefix_match or contains_match
-            
-            return False
-# --- 引入必要的函式庫 ---
+def bulk_test_rules(rules):
+    """批次測試：一次評估整份產品編號清單，顯示各規則符合筆數、未分類的資料與分類重疊矩陣"""
+    source = st.radio("資料來源：", ["貼上清單", "上傳 Excel"], horizontal=True)
+    prod_codes = currencies = None
+    if source == "貼上清單":
+        text = st.text_area(
+            "每行一筆「產品編號,幣別」（可直接從 Excel 複製兩欄貼上，幣別可省略）：",
+            height=150,
+            placeholder="4KB2AAP,NTD\nKB123,USD",
+        )
+        if text.strip():
+            prod_codes, currencies = parse_test_codes(text)
+    else:
+        test_file = st.file_uploader("上傳含產品編號的 Excel 檔案", type=['xlsx'], key="bulk_test_file")
+        if test_file is not None:
+            # 與主要上傳檔案共用相同的快取讀取方式：只讀取標題列與選定的欄位
+            test_bytes, test_hash = test_file.getvalue(), upload_content_hash(test_file)
+            sheet_names = list_workbook_sheets(test_hash, test_bytes)
+            sheet_name = sheet_names[default_sheet_index_for(sheet_names)]
+            header = load_sheet_header(test_hash, sheet_name, test_bytes)
+            prod_col = st.selectbox("產品編號欄位：", header, key="bulk_test_prod_col")
+            currency_col = st.selectbox("幣別欄位：", ["（不指定）", *header], key="bulk_test_currency_col")
+            usecols = (prod_col,) if currency_col == "（不指定）" else tuple(dict.fromkeys([prod_col, currency_col]))
+            test_df = load_sheet_columns(test_hash, sheet_name, usecols, usecols, test_bytes)
+            prod_codes = test_df[prod_col]
+            currencies = pd.Series("", index=test_df.index) if currency_col == "（不指定）" else test_df[currency_col]
+
+    if prod_codes is None or not st.button("🔍 批次測試"):
+        return
+    diagnostics = Diagnostics()
+    with diagnostics.stage("批次測試", len(prod_codes)):
+        coverage = rule_coverage(rules, prod_codes, currencies, diagnostics)
+    for message in diagnostics.warnings:
+        st.warning(message)
+
+    total = len(prod_codes)
+    other_count = int(coverage.unmatched["筆數"].sum())
+    st.caption(f"共 {total:,} 筆，耗時 {diagnostics.timings[-1]['seconds']:.2f} 秒；未符合任何規則（其他）{other_count:,} 筆")
+    st.write("**各規則符合筆數**（被優先規則取走：符合此規則，但已由順序較前的規則分類）")
+    st.dataframe(coverage.hits.style.format({"最終分類占比": "{:.1%}"}), hide_index=True)
+    st.write("**分類重疊矩陣**（同時符合兩條規則的筆數，對角線為符合筆數；非對角線的資料由優先順序決定分類）")
+    st.dataframe(coverage.overlap)
+    st.write("**未符合任何規則的資料**（依筆數排序，最多顯示 1000 組）")
+    st.dataframe(coverage.unmatched.head(1000), hide_index=True)
+
 # --- 修改後的分類函式 ---
-def assign_main_category_dynamic(df, prod_col, currency_col, rules):
+def assign_main_category_dynamic(df, columns, rules, diagnostics=None, analysis=None, workers=None, trace=None):
     """
     動態分類函式：根據使用者自訂的規則進行分類
-    支援除錯模式，顯示前5筆資料的詳細分類邏輯
-    第一階段：檢查是否為進口
-    第二階段：對非進口品按產品編號分類
+    傳入 IncrementalAnalysis 時，規則修改後只重新分類受影響的資料（回傳新的 DataFrame）
+    指定 workers 時依列範圍分片，以多個行程平行分類
+    傳入 RuleTrace 時（除錯模式），分類後重現抽樣資料的逐條比對過程，以一個表格顯示
+    順序：進口 → 板金 → 加工件 → 電料 → 市購件 → 自訂分類，皆不符合為「其他」
     """
-    
-    def classify_row(row, show_debug=False):
-        try:
-            prod_code = str(row[prod_col]).strip() if pd.notna(row[prod_col]) else ""
-            currency = str(row[currency_col]).strip().upper() if pd.notna(row[currency_col]) else ""
-            
-            if show_debug:
-                st.markdown(f"---")
-                st.write(f"🔍 分析項目: {prod_code}")
-                st.write(f"💱 幣別: {currency}")
-            # 第一階段：優先檢查是否為進口
-            if "進口" in rules:
-                import_check = check_rule(prod_code, currency, rules["進口"])
-                if show_debug:
-                    match_status = "✅" if import_check else "❌"
-                    st.write(f"**🌍 第一階段：檢查進口**")
-                    st.write(f"{match_status} 檢查 進口 規則: {rules['進口']['description']}")
-                
-                if import_check:
-                    if show_debug:
-                        st.success(" 符合進口條件 → **分類：進口**")
-                    return "進口"
-                else:
-                    if show_debug:
-                        st.info(" 不符合進口條件 → 繼續檢查國產品分類")
-            
-            # 第二階段：對非進口品按產品編號進行細分
-            if show_debug:
-                st.write(f"**第二階段：檢查國產品分類**")
-            
-            # 確保板金優先判斷
-            domestic_categories = ["板金", "加工件", "電料", "市購件"]
-            for category in domestic_categories:
-                if category in rules:
-                    rule_match = check_rule(prod_code, currency, rules[category])
-                    
-                    if show_debug:
-                        match_status = "✅" if rule_match else "❌"
-                        st.write(f"- **{category}**: {match_status}")
-                        st.write(f"  └─ 規則：{rules[category]['description']}")
-                    
-                    if rule_match:
-                        if show_debug:
-                            st.success(f" **符合條件，分類為：{category}**")
-                        return category
-            
-            if show_debug:
-                st.warning(" **未符合任何規則，歸類為「其他」**")
-            return "其他"
-            
-        except Exception as e:
-            st.warning(f"分類處理錯誤：{e}")
-            return "錯誤"
-            
-    # 檢查除錯模式
-    debug_mode = 'debug_mode' in st.session_state and st.session_state.debug_mode
-    
-    if debug_mode:
-        st.write("### 🔍 前5筆資料分類過程")
-        # 只對前5筆資料顯示除錯資訊
-        for idx, row in df.head().iterrows():
-            st.write(f"#### 第 {idx+1} 筆資料")
-            df.at[idx, '分類'] = classify_row(row, show_debug=True)
-        # 處理剩餘資料
-        for idx, row in df.iloc[5:].iterrows():
-            df.at[idx, '分類'] = classify_row(row, show_debug=False)
+    # 規則只編譯一次，整欄分類與除錯追蹤共用
+    compiled_rules = compile_rules(rules)
+
+    # 整欄向量化分類，相同料號只分類一次；備忘表在整個工作階段沿用
+    diagnostics = Diagnostics() if diagnostics is None else diagnostics
+    shown = len(diagnostics.warnings)
+    if analysis is not None:
+        df = analysis.classify(compiled_rules, diagnostics)
     else:
-        # 一般模式：直接應用分類
-        df['分類'] = df.apply(lambda row: classify_row(row, show_debug=False), axis=1)
-    
+        memo = st.session_state.setdefault("classification_memo", ClassificationMemo())
+        if workers:
+            df = classify_parallel(df, compiled_rules, columns, diagnostics, workers, memo)
+        else:
+            df = classify(df, compiled_rules, columns, diagnostics, memo)
+    for message in diagnostics.warnings[shown:]:
+        st.warning(message)
+
+    if trace is not None:
+        with diagnostics.stage("除錯追蹤", len(df)):
+            descriptions = {category: rules[category].get("description", "") for category, _ in compiled_rules}
+            trace.record(compiled_rules, df[columns.prod_col], df[columns.currency_col], df['分類'], descriptions)
+        st.write("### 🔍 分類過程追蹤")
+        st.caption("依優先順序逐條比對，符合第一條規則即停止；「分類」為整欄分類的結果")
+        st.dataframe(trace.frame(), hide_index=True)
+
     return df
 
-def perform_abc_analysis(df, qty_col, price_col):
+def perform_abc_analysis(df, columns, diagnostics=None, analysis=None, workers=None, thresholds=ABC_THRESHOLDS):
     """
-    第二階段：在每個主分類內部，獨立進行 ABC 分析
+    第二階段：在每個主分類內部，獨立進行 ABC 分析（計算由 abc_core 處理，這裡負責顯示）
+    傳入 IncrementalAnalysis 時，只對成員有變動的分類重新計算；指定 workers 時以多個行程平行計算
     """
+    qty_col, price_col = columns.qty_col, columns.price_col
     try:
-        # 新增：數值清理函數
-        def clean_numeric_value(value):
-            """清理數值，處理常見的格式問題"""
-            if pd.isna(value):
-                return 0
-            
-            # 轉為字串處理
-            str_value = str(value).strip()
-            
-            # 移除常見的非數字字符
-            str_value = str_value.replace(',', '')    # 移除千分位符號
-            str_value = str_value.replace('$', '')    # 移除貨幣符號
-            str_value = str_value.replace('￥', '')   # 移除日幣符號
-            str_value = str_value.replace('€', '')    # 移除歐元符號
-            str_value = str_value.replace(' ', '')    # 移除空格
-            str_value = str_value.replace('\t', '')   # 移除Tab
-            str_value = str_value.replace('\n', '')   # 移除換行
-            
-            # 處理特殊值
-            if str_value.lower() in ['', '-', 'n/a', 'na', 'tbd', '待定', 'nan', 'null', '#n/a']:
-                return 0
-            
-            # 處理百分比
-            if str_value.endswith('%'):
-                try:
-                    return float(str_value[:-1]) / 100
-                except:
-                    return 0
-            
-            # 嘗試轉換為數字
-            try:
-                return float(str_value)
-            except ValueError:
-                # 如果還是無法轉換，嘗試提取數字
-                import re
-                numbers = re.findall(r'-?\d+\.?\d*', str_value)
-                if numbers:
-                    return float(numbers[0])
-                return 0
-        
         # 資料品質診斷（可選，用於除錯）
         if hasattr(st.session_state, 'debug_mode') and st.session_state.debug_mode:
             st.write("### 🔍 數值轉換診斷")
             
-            # 檢查前5筆的原始資料
-            sample_data = df.head().copy()
+            # 檢查前5筆的原始資料（一個表格顯示，不逐筆輸出）
+            sample_data = df.head()
             st.write("**原始資料樣本：**")
-            for idx, row in sample_data.iterrows():
-                qty_value = row[qty_col]
-                price_value = row[price_col]
-                st.write(f"第{idx+1}筆 - 需求數: `{qty_value}` (類型: {type(qty_value).__name__}) | 單價: `{price_value}` (類型: {type(price_value).__name__})")
+            st.dataframe(pd.DataFrame({
+                "需求數": sample_data[qty_col].astype(str),
+                "需求數類型": sample_data[qty_col].map(lambda value: type(value).__name__),
+                "單價": sample_data[price_col].astype(str),
+                "單價類型": sample_data[price_col].map(lambda value: type(value).__name__),
+            }))
         
         # 進行數值清理和轉換
         st.info("正在清理和轉換數值格式...")
-        
-        # 清理需求數和單價
-        df['需求數_清理'] = df[qty_col].apply(clean_numeric_value)
-        df['單價_清理'] = df[price_col].apply(clean_numeric_value)
-        
-        # 計算金額
-        df['金額'] = df['需求數_清理'] * df['單價_清理']
-        
-        # 統計轉換結果
-        original_qty_types = df[qty_col].apply(lambda x: type(x).__name__).value_counts()
-        original_price_types = df[price_col].apply(lambda x: type(x).__name__).value_counts()
-        
-        zero_qty_count = (df['需求數_清理'] == 0).sum()
-        zero_price_count = (df['單價_清理'] == 0).sum()
-        zero_amount_count = (df['金額'] == 0).sum()
+        diagnostics = Diagnostics() if diagnostics is None else diagnostics
+        shown = len(diagnostics.warnings)
+        if analysis is not None:
+            df = analysis.abc(df, diagnostics, thresholds)
+        elif workers:
+            df = abc_parallel(df, columns, diagnostics, workers, thresholds)
+        else:
+            df = abc(df, columns, diagnostics, thresholds)
+        qty_stats = diagnostics.numeric_stats["需求數"]
+        price_stats = diagnostics.numeric_stats["單價"]
+        amount_stats = diagnostics.numeric_stats["金額"]
         
         # 顯示轉換統計
         with st.expander("📊 數值轉換統計", expanded=False):
@@ -691,54 +661,32 @@ def perform_abc_analysis(df, qty_col, price_col):
             
             with col1:
                 st.write("**需求數統計**")
-                st.write(f"- 原始資料類型: {dict(original_qty_types)}")
-                st.write(f"- 轉換為0的筆數: {zero_qty_count}")
-                st.write(f"- 有效數值: {len(df) - zero_qty_count}")
+                st.write(f"- 原始資料類型: {qty_stats['types']}")
+                st.write(f"- 轉換為0的筆數: {qty_stats['zero_count']}")
+                st.write(f"- 有效數值: {qty_stats['valid_count']}")
             
             with col2:
                 st.write("**單價統計**")
-                st.write(f"- 原始資料類型: {dict(original_price_types)}")
-                st.write(f"- 轉換為0的筆數: {zero_price_count}")
-                st.write(f"- 有效數值: {len(df) - zero_price_count}")
+                st.write(f"- 原始資料類型: {price_stats['types']}")
+                st.write(f"- 轉換為0的筆數: {price_stats['zero_count']}")
+                st.write(f"- 有效數值: {price_stats['valid_count']}")
             
             with col3:
                 st.write("**金額統計**")
-                st.write(f"- 金額為0的筆數: {zero_amount_count}")
-                st.write(f"- 有效金額: {len(df) - zero_amount_count}")
-                st.write(f"- 總金額: {df['金額'].sum():,.2f}")
+                st.write(f"- 金額為0的筆數: {amount_stats['zero_count']}")
+                st.write(f"- 有效金額: {amount_stats['valid_count']}")
+                st.write(f"- 總金額: {amount_stats['total']:,.2f}")
         
         # 如果有異常值，顯示警告
-        if zero_amount_count > len(df) * 0.1:  # 超過10%的資料金額為0
-            st.warning(f"⚠️ 注意：有 {zero_amount_count} 筆資料的金額為0，請檢查原始資料品質")
+        for message in diagnostics.warnings[shown:]:
+            st.warning(message)
         
         # 顯示無法轉換的資料樣本（除錯用）
         if hasattr(st.session_state, 'debug_mode') and st.session_state.debug_mode:
-            if zero_amount_count > 0:
+            if amount_stats['zero_count'] > 0:
                 st.write("**金額為0的資料樣本：**")
-                zero_samples = df[df['金額'] == 0].head(3)
-                for idx, row in zero_samples.iterrows():
-                    st.write(f"- 第{idx+1}筆: 需求數 `{row[qty_col]}` → `{row['需求數_清理']}`, 單價 `{row[price_col]}` → `{row['單價_清理']}`")
-
-        # 對 DataFrame 進行排序，以便後續計算累計值
-        df = df.sort_values(by=['分類', '金額'], ascending=[True, False])
-
-        # 使用 groupby() 按「分類」分組，並在組內計算累計百分比
-        df['累計金額'] = df.groupby('分類')['金額'].cumsum()
-        group_totals = df.groupby('分類')['金額'].transform('sum')
-        df['累計百分比'] = (df['累計金額'] / group_totals).fillna(0)
-
-        # 根據累計百分比分配 ABC 類別
-        def assign_abc_category(row):
-            if row['金額'] == 0:
-                return 'C'
-            elif row['累計百分比'] <= 0.7:
-                return 'A'
-            elif row['累計百分比'] <= 0.9:
-                return 'B'
-            else:
-                return 'C'
-        
-        df['ABC類別'] = df.apply(assign_abc_category, axis=1)
+                zero_samples = df.loc[df['金額'] == 0, [qty_col, '需求數_清理', price_col, '單價_清理']].head(3)
+                st.dataframe(zero_samples.astype({qty_col: str, price_col: str}))
 
         return df
     
@@ -746,8 +694,197 @@ def perform_abc_analysis(df, qty_col, price_col):
         st.error(f"ABC分析過程中發生錯誤：{e}")
         return df
     
+def render_performance_panel(timings, rows, from_cache=False, profiler=None):
+    """效能統計：各階段耗時、每秒筆數、記憶體高峰增加量與筆數，可下載 JSON 交給維運人員"""
+    with st.expander("⏱️ 效能統計", expanded=False):
+        if from_cache:
+            st.caption("本次結果由快取載入，未重新計算；以下只有本次讀取與最近一次匯出的紀錄")
+        if timings:
+            table = pd.DataFrame(timings).rename(columns={
+                "stage": "階段",
+                "rows_in": "輸入筆數",
+                "rows_out": "輸出筆數",
+                "seconds": "秒數",
+                "rows_per_second": "每秒筆數",
+                "peak_rss_mb": "記憶體高峰(MB)",
+                "peak_rss_delta_mb": "高峰增加(MB)",
+            })
+            st.dataframe(table, hide_index=True)
+            st.write(f"合計 {sum(record['seconds'] for record in timings):.2f} 秒")
+
+        report = {
+            "environment": environment_info(),
+            "rows": rows,
+            "from_cache": from_cache,
+            "stages": timings,
+        }
+        st.download_button(
+            label="下載效能紀錄 (JSON)",
+            data=json.dumps(report, ensure_ascii=False, indent=2),
+            file_name="performance.json",
+            mime="application/json"
+        )
+
+        if profiler is not None:
+            st.markdown(f"**效能剖析（{profiler.engine}）**")
+            st.code(profiler.report_text(), language=None)
+            file_name, data, mime = profiler.report_file()
+            st.download_button(label="下載效能剖析檔", data=data, file_name=file_name, mime=mime)
+
+def get_incremental_analysis(df, columns, source_key, diagnostics):
+    """同一份資料（檔案、工作表、讀取欄位與欄位對應）在工作階段內共用 IncrementalAnalysis"""
+    cached = st.session_state.get("incremental_analysis")
+    if cached is not None and cached[0] == source_key:
+        return cached[1]
+    memo = st.session_state.setdefault("classification_memo", ClassificationMemo())
+    with diagnostics.stage("產品編號編碼", len(df)):
+        analysis = IncrementalAnalysis(df, columns, memo)
+    st.session_state.incremental_analysis = (source_key, analysis)
+    return analysis
+
+def session_footprint_mb(tables, source):
+    """本工作階段的分類結果、統計表與增量分析實際占用的記憶體（MB），不含由各工作階段共用的原始資料"""
+    cached = st.session_state.get("incremental_analysis")
+    arrays = cached[1].arrays() if cached is not None else []
+    return footprint_mb([*tables.values(), *arrays], shared=source)
+
+def apply_result_layout(tables, result_key, columns, compact, source):
+    """
+    依「精簡結果記憶體」選項轉換分類結果（直接更新 tables，選項不變時不重複轉換），
+    精簡時與原始資料 source 共用的欄位維持原樣，並釋放增量分析保留的數值與 ABC 欄位；
+    回傳 (分類結果, (result_key, 轉換前 MB, 轉換後 MB))
+    """
+    frame = tables["分類結果"]
+    converted = compact_result(frame, columns, shared=source) if compact else expand_result(frame, columns)
+    report = st.session_state.get("memory_report")
+    if converted is not frame:
+        before = session_footprint_mb(tables, source)
+        tables["分類結果"] = converted
+        cached = st.session_state.get("incremental_analysis")
+        if compact and cached is not None:
+            cached[1].release()
+        after = session_footprint_mb(tables, source)
+        report = (result_key, before, after) if compact else (result_key, after, after)
+    elif report is None or report[0] != result_key:
+        size = session_footprint_mb(tables, source)
+        report = (result_key, size, size)
+    st.session_state.memory_report = report
+    return converted, report
+
+def render_scenario_panel(frame, result_key, columns, thresholds):
+    """ABC 門檻情境比較：多組門檻 × 排序基準，每個基準只排序一次，結果依分類列出筆數與金額占比"""
+    with st.expander("🔀 ABC 門檻情境比較", expanded=False):
+        a_percent, b_percent = (f"{value * 100:g}" for value in thresholds)
+        pairs_text = st.text_input(
+            "門檻組合（A/B，單位 %，以逗號分隔）：",
+            value=f"{a_percent}/{b_percent}, 80/95, 60/85",
+        )
+        bases = st.multiselect(
+            "排序基準：", list(SCENARIO_BASES), default=["金額"],
+            help="筆數：依金額排序，但以品項筆數累計（例如前 70% 的筆數為 A）"
+        )
+        if st.button("計算情境"):
+            try:
+                pairs = parse_threshold_pairs(pairs_text)
+            except ValueError as e:
+                st.error(f"門檻組合格式錯誤：{e}")
+                return
+            st.session_state.scenario_result = (result_key, abc_scenarios(frame, pairs, bases, columns))
+
+        cached = st.session_state.get("scenario_result")
+        if not cached or cached[0] != result_key or cached[1].empty:
+            return
+        table = cached[1]
+        st.markdown("**各情境的品項筆數**")
+        st.dataframe(scenario_matrix(table, "筆數"))
+        st.markdown("**各情境的金額占比**（該分類總金額中的占比）")
+        st.dataframe(scenario_matrix(table, "金額占比").style.format("{:.1%}"))
+        st.download_button(
+            "下載情境比較（CSV）",
+            data=export_frame(table, "csv"),
+            file_name="abc_scenarios.csv",
+            mime="text/csv",
+        )
+
+def build_export(frame, tables, columns, result_key, export_format, include_stats):
+    """
+    回傳 (產生下載內容的函式, 匯出階段紀錄)
+    下載內容在按下下載按鈕時才產生，下載完即釋放，不保存在工作階段；
+    工作階段只保存最近一次匯出的階段紀錄，於之後重新執行時顯示在效能統計
+    """
+    export_key = (result_key, export_format, include_stats)
+    export_timings = st.session_state.setdefault("export_timings", {})
+
+    def generate():
+        # 於另一個執行緒執行，不能呼叫 Streamlit；階段紀錄寫入工作階段保存的 dict
+        extra_sheets = {name: table for name, table in tables.items() if name != "分類結果"} if include_stats else None
+        export_diagnostics = Diagnostics()
+        with export_diagnostics.stage(f"匯出（{EXPORT_FORMATS[export_format][0]}）", len(frame)):
+            data = export_frame(expand_result(frame, columns), export_format, extra_sheets)
+        export_timings.clear()
+        export_timings[export_key] = export_diagnostics.timings
+        return data
+
+    return generate, export_timings.get(export_key, [])
+
+def get_result_view(frame, result_key, currency_col):
+    """每個結果只建立一次 ResultView（篩選欄位編碼、篩選與排序結果），重新執行畫面時沿用"""
+    cached = st.session_state.get("result_view")
+    if cached is not None and cached[0] == (result_key, currency_col) and cached[1].frame is frame:
+        return cached[1]
+    filter_columns = list(dict.fromkeys(["分類", "ABC類別", currency_col]))
+    view = ResultView(frame, filter_columns)
+    st.session_state.result_view = ((result_key, currency_col), view)
+    return view
+
+def render_result_viewer(frame, result_key, currency_col):
+    """分類結果的分頁檢視：依分類、ABC類別、幣別篩選，可選擇顯示欄位並依金額排序"""
+    view = get_result_view(frame, result_key, currency_col)
+    blank = "（空白）"
+
+    filter_col1, filter_col2, filter_col3 = st.columns(3)
+    with filter_col1:
+        selected_categories = st.multiselect("篩選分類：", view.options("分類"))
+    with filter_col2:
+        selected_abc = st.multiselect("篩選 ABC 類別：", sorted(view.options("ABC類別")))
+    with filter_col3:
+        selected_currencies = st.multiselect(
+            "篩選幣別：",
+            view.options(currency_col),
+            format_func=lambda value: value or blank
+        )
+
+    option_col1, option_col2 = st.columns([3, 1])
+    with option_col1:
+        shown_columns = st.multiselect(
+            "顯示欄位：",
+            range(frame.shape[1]),
+            default=list(range(frame.shape[1])),
+            format_func=lambda position: str(frame.columns[position])
+        )
+    with option_col2:
+        sort_order = st.selectbox("排序：", ["原始順序", "金額由大到小", "金額由小到大"])
+
+    filters = {"分類": selected_categories, "ABC類別": selected_abc}
+    # 幣別欄位與分類欄位相同時（理論上不會發生），以分類篩選為準
+    filters.setdefault(currency_col, selected_currencies)
+    positions = view.positions(
+        filters,
+        sort_by=None if sort_order == "原始順序" else "金額",
+        ascending=sort_order == "金額由小到大"
+    )
+
+    page_col1, page_col2 = st.columns([1, 3])
+    with page_col1:
+        page_size = st.selectbox("每頁筆數：", [50, 100, 500, 1000], index=1)
+    page_count = max(1, -(-len(positions) // page_size))
+    with page_col2:
+        page = st.number_input(f"頁數（共 {page_count} 頁）：", min_value=1, max_value=page_count, value=1, step=1)
+
+    st.caption(f"符合條件 {len(positions):,} 筆／共 {len(frame):,} 筆")
+    st.dataframe(view.page(positions, int(page) - 1, page_size, shown_columns or None))
+
 # --- 修改後的主介面 ---
-st.set_page_config(page_title="智慧物料分類工具", layout="wide")
 st.title('智慧物料 ABC 分類工具')
 st.write('上傳 Excel，系統將依據您設定的規則進行「主分類」與「ABC 分類」。')
 
@@ -762,9 +899,19 @@ test_rules(classification_rules)
 
 # 新增：除錯模式設定
 st.subheader("除錯模式")
-st.session_state.debug_mode = st.checkbox("啟用除錯模式（顯示前5筆資料的詳細分類過程）")
+st.session_state.debug_mode = st.checkbox("啟用除錯模式（追蹤抽樣資料的分類過程）")
+trace_sample_size, trace_prod_codes = 5, ""
 if st.session_state.debug_mode:
-    st.info("除錯模式已啟用，將在分類時顯示前5筆資料的詳細分類邏輯")
+    trace_col1, trace_col2 = st.columns([1, 2])
+    with trace_col1:
+        trace_sample_size = st.number_input("追蹤前幾筆資料", min_value=0, max_value=200, value=5, step=1)
+    with trace_col2:
+        trace_prod_codes = st.text_area(
+            "另外追蹤的產品編號（以逗號或換行分隔）",
+            height=68,
+            help="只追蹤抽樣的資料，分類仍以整欄方式進行，大量資料也不會變慢"
+        )
+    st.info("除錯模式已啟用，分類後以表格顯示抽樣資料逐條比對規則的過程")
 
 # 步驟2：檔案上傳
 st.subheader("檔案上傳")
@@ -772,29 +919,36 @@ uploaded_file = st.file_uploader("請選擇你的 Excel 檔案", type=['xlsx'])
 
 if uploaded_file is not None:
     try:
-        # 取得工作表
-        xls = pd.ExcelFile(uploaded_file)
-        sheet_names = xls.sheet_names
+        # 取得工作表（以內容雜湊快取，切換選項時不會重新解析活頁簿）
+        file_bytes = uploaded_file.getvalue()
+        file_hash = upload_content_hash(uploaded_file)
+        sheet_names = list_workbook_sheets(file_hash, file_bytes)
         
         st.info("偵測到以下工作表，請選擇包含資料的工作表：")
         
         # 改善預設工作表選擇邏輯
-        default_sheet_index = 0
-        if "uservo2000" in sheet_names:
-            default_sheet_index = sheet_names.index("uservo2000")
-        elif "分類物料" in sheet_names:
-            default_sheet_index = sheet_names.index("分類物料")
-        elif len(sheet_names) > 0:
-            default_sheet_index = 0
+        default_sheet_index = default_sheet_index_for(sheet_names)
 
         selected_sheet = st.selectbox(
             label="選擇工作表", 
             options=sheet_names,
             index=default_sheet_index,
         )
+
+        read_mode = st.radio(
+            "讀取模式：",
+            ["完整讀取", "快速讀取（只讀取對應欄位）"],
+            horizontal=True,
+            help="大型檔案建議使用快速讀取：先讀取標題列，選好欄位後只讀取需要的欄位"
+        )
+        fast_read = read_mode != "完整讀取"
         
-        if selected_sheet:
-            df_original = pd.read_excel(uploaded_file, sheet_name=selected_sheet)
+        # 讀取階段的效能紀錄（工作表已快取時幾乎不花時間）
+        load_diagnostics = Diagnostics()
+        if selected_sheet and not fast_read:
+            with load_diagnostics.stage("讀取工作表") as record:
+                df_original = load_workbook_sheet(file_hash, selected_sheet, file_bytes)
+                record["rows_out"] = len(df_original)
             st.success(f"成功讀取工作表：`{selected_sheet}`！")
             st.dataframe(df_original.head())
 
@@ -807,7 +961,7 @@ if uploaded_file is not None:
             "price_col": "單價"
         }
         
-        all_columns = df_original.columns.tolist()
+        all_columns = load_sheet_header(file_hash, selected_sheet, file_bytes) if fast_read else df_original.columns.tolist()
         
         col1, col2 = st.columns(2)
         with col1:
@@ -817,63 +971,171 @@ if uploaded_file is not None:
             qty_col_selected = st.selectbox(f"選擇 '{required_cols['qty_col']}' 對應的欄位:", all_columns, index=3 if len(all_columns) > 3 else 0)
             price_col_selected = st.selectbox(f"選擇 '{required_cols['price_col']}' 對應的欄位:", all_columns, index=4 if len(all_columns) > 4 else 0)
 
-        # 執行分類
-        if st.button(" 開始執行完整分類", type="primary"):
+        if fast_read:
+            mapped_columns = list(dict.fromkeys([prod_col_selected, currency_col_selected, qty_col_selected, price_col_selected]))
+            extra_columns = st.multiselect(
+                "額外保留的欄位（一併輸出到結果）：",
+                [c for c in all_columns if c not in mapped_columns]
+            )
+            usecols = tuple(c for c in all_columns if c in mapped_columns or c in extra_columns)
+            with load_diagnostics.stage("讀取工作表（快速）") as record:
+                df_original = load_sheet_columns(
+                    file_hash, selected_sheet, usecols, (prod_col_selected, currency_col_selected), file_bytes
+                )
+                record["rows_out"] = len(df_original)
+            st.success(f"成功讀取工作表：`{selected_sheet}`（{len(usecols)} 個欄位）！")
+            st.dataframe(df_original.head())
+
+        # ABC 門檻（各分類內的累計金額百分比）
+        threshold_col1, threshold_col2 = st.columns(2)
+        with threshold_col1:
+            a_percent = st.number_input("A 類門檻（累計百分比 %）", min_value=1.0, max_value=100.0, value=70.0, step=5.0)
+        with threshold_col2:
+            b_percent = st.number_input("B 類門檻（累計百分比 %）", min_value=1.0, max_value=100.0, value=90.0, step=5.0)
+        if b_percent < a_percent:
+            st.warning("B 類門檻小於 A 類門檻，將以 A 類門檻計算（沒有 B 類）")
+            b_percent = a_percent
+        abc_thresholds = (a_percent / 100, b_percent / 100)
+
+        # 匯出設定
+        export_col1, export_col2 = st.columns(2)
+        with export_col1:
+            export_format = st.selectbox(
+                "下載格式：",
+                available_export_formats(),
+                format_func=lambda name: EXPORT_FORMATS[name][0]
+            )
+            compact_results = st.checkbox(
+                "精簡結果記憶體",
+                help="分類、ABC類別、幣別改為類別型別，不保留需求數_清理、單價_清理、累計金額（下載時自動補回），多人同時使用時可節省伺服器記憶體；調整規則後重新執行時需重新轉換數值"
+            )
+        with export_col2:
+            include_stats_sheets = st.checkbox(
+                "Excel 包含統計工作表（主分類、ABC、金額、交叉分析、分類ABC彙總）",
+                disabled=export_format != "xlsx"
+            )
+            parallel_run = default_workers() > 1 and st.checkbox(
+                f"多核心平行處理（{default_workers()} 個行程）",
+                help="資料分片後由多個行程同時分類與計算 ABC，適合數十萬筆以上的資料；結果與一般處理相同，但調整規則後不會只重算受影響的資料"
+            )
+            profile_run = st.checkbox("記錄效能剖析（執行時會稍微變慢）")
+            if profile_run and len(profile_engines()) > 1:
+                profile_engine = st.radio("剖析工具：", profile_engines(), horizontal=True)
+            else:
+                profile_engine = "cProfile"
+
+        # 執行分類（相同檔案、規則與欄位對應的結果直接從快取載入；除錯模式一律重新計算以顯示分類過程）
+        columns = ColumnMapping(prod_col_selected, currency_col_selected, qty_col_selected, price_col_selected)
+        result_key = result_cache_key(
+            file_hash, classification_rules, selected_sheet, columns, usecols if fast_read else None, abc_thresholds
+        )
+        run_clicked = st.button(" 開始執行完整分類", type="primary")
+        result = None
+        if not (run_clicked and st.session_state.debug_mode):
+            result = load_cached_result(result_key)
+            if result is not None:
+                st.info("已載入先前的分類結果（相同檔案、規則、欄位對應與 ABC 門檻），如需重新計算請啟用除錯模式後執行")
+                for message in result[1].warnings:
+                    st.warning(message)
+
+        if result is None and run_clicked:
             with st.spinner('正在進行分類，請稍候...'):
-                df_processed = df_original.copy()
-                
-                # 使用動態規則進行分類
-                df_processed = assign_main_category_dynamic(df_processed, prod_col_selected, currency_col_selected, classification_rules)
-                
-                # ABC 分析
-                df_final = perform_abc_analysis(df_processed, qty_col_selected, price_col_selected)
+                diagnostics = Diagnostics(timings=list(load_diagnostics.timings))
+                profiler = RunProfiler(profile_engine) if profile_run else nullcontext()
+                with profiler:
+                    # 同一份資料調整規則後重新執行時，只重算受影響的資料（平行處理時每次完整計算）
+                    workers = default_workers() if parallel_run else None
+                    analysis = None
+                    df_processed = df_original
+                    if parallel_run:
+                        # df_original 由所有重新執行與工作階段共用，平行分類會直接加上欄位，先複製
+                        # （寫入時複製，淺複製即可，不會複製資料本身）
+                        with diagnostics.stage("複製資料", len(df_original)):
+                            df_processed = df_original.copy(deep=False)
+                    else:
+                        source_key = (file_hash, selected_sheet, usecols if fast_read else None, columns)
+                        analysis = get_incremental_analysis(df_original, columns, source_key, diagnostics)
+                    
+                    # 使用動態規則進行分類（除錯模式另外追蹤抽樣資料的比對過程）
+                    trace = None
+                    if st.session_state.debug_mode:
+                        trace = RuleTrace(int(trace_sample_size), clean_code_list(trace_prod_codes))
+                    df_processed = assign_main_category_dynamic(
+                        df_processed, columns, classification_rules, diagnostics, analysis, workers, trace
+                    )
+                    
+                    # ABC 分析
+                    df_final = perform_abc_analysis(df_processed, columns, diagnostics, analysis, workers, abc_thresholds)
+                    
+                    with diagnostics.stage("統計", len(df_final)):
+                        tables = summary_tables(df_final)
                 
+                apply_result_layout(tables, result_key, columns, compact_results, df_original)
+                result = (tables, diagnostics)
+                store_result(result_key, *result)
+                st.session_state.last_profile = (result_key, profiler) if profile_run else None
                 st.success("分類完成！")
-                
-                # 顯示分類統計
-                st.subheader("分類統計")
-                # 基本統計
-                category_stats = df_final['分類'].value_counts()
-                abc_stats = df_final['ABC類別'].value_counts()
-                
-                col1, col2, col3 = st.columns(3)
-                
-                with col1:
-                    st.markdown("**主分類統計**")
-                    st.bar_chart(category_stats)
-                    st.dataframe(category_stats.rename("數量"))
-                
-                with col2:
-                    st.markdown("**ABC分類統計**")
-                    st.bar_chart(abc_stats)
-                    st.dataframe(abc_stats.rename("數量"))
-                
-                with col3:
-                    st.markdown("**金額統計**")
-                    amount_by_category = df_final.groupby('分類')['金額'].sum().sort_values(ascending=False)
-                    st.bar_chart(amount_by_category)
-                    st.dataframe(amount_by_category.rename("總金額"))
-                
-                # 新增：交叉分析表
-                st.subheader("交叉分析")
-                cross_analysis = pd.crosstab(df_final['分類'], df_final['ABC類別'], margins=True)
-                st.dataframe(cross_analysis)
-                
-                # 顯示結果
-                st.subheader("分類結果")
-                st.dataframe(df_final)
-
-                # 下載功能
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    df_final.to_excel(writer, index=False, sheet_name='分類結果')
-                
-                st.download_button(
-                    label="下載分類後的 Excel 檔案",
-                    data=output.getvalue(),
-                    file_name="classified_materials_output.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+
+        if result is not None:
+            tables = result[0]
+            df_final, memory_report = apply_result_layout(tables, result_key, columns, compact_results, df_original)
+
+            # 顯示分類統計
+            st.subheader("分類統計")
+            col1, col2, col3 = st.columns(3)
+            
+            with col1:
+                st.markdown("**主分類統計**")
+                st.bar_chart(tables["主分類統計"])
+                st.dataframe(tables["主分類統計"])
+            
+            with col2:
+                st.markdown("**ABC分類統計**")
+                st.bar_chart(tables["ABC分類統計"])
+                st.dataframe(tables["ABC分類統計"])
+            
+            with col3:
+                st.markdown("**金額統計**")
+                st.bar_chart(tables["金額統計"])
+                st.dataframe(tables["金額統計"])
+            
+            # 新增：交叉分析表
+            st.subheader("交叉分析")
+            st.dataframe(tables["交叉分析"])
+            render_scenario_panel(df_final, result_key, columns, abc_thresholds)
+            
+            # 顯示結果（伺服器端篩選與分頁，只傳送目前這一頁）
+            st.subheader("分類結果")
+            _, memory_before, memory_after = memory_report
+            if memory_before != memory_after:
+                st.caption(f"本工作階段的結果占用記憶體（不含共用的原始資料）：{memory_before:,.1f} MB → 精簡後 {memory_after:,.1f} MB")
+            else:
+                st.caption(f"本工作階段的結果占用記憶體（不含共用的原始資料）：{memory_after:,.1f} MB")
+            render_result_viewer(df_final, result_key, currency_col_selected)
+
+            # 下載功能
+            format_label, mime = EXPORT_FORMATS[export_format]
+            export_data, export_timings = build_export(
+                df_final, tables, columns, result_key, export_format, export_format == "xlsx" and include_stats_sheets
+            )
+            
+            st.download_button(
+                label=f"下載分類後的 {format_label} 檔案",
+                data=export_data,  # 按下時才產生
+                file_name=f"classified_materials_output.{export_format}",
+                mime=mime
+            )
+
+            # 快取結果沒有計算階段的紀錄，只顯示本次的讀取與最近一次匯出
+            from_cache = not result[1].timings
+            stage_timings = load_diagnostics.timings if from_cache else result[1].timings
+            last_profile = st.session_state.get("last_profile")
+            render_performance_panel(
+                stage_timings + export_timings,
+                rows=len(df_final),
+                from_cache=from_cache,
+                profiler=last_profile[1] if last_profile and last_profile[0] == result_key else None,
+            )
 
     except Exception as e:
         st.error(f"處理檔案時發生錯誤：{e}")
@@ -0,0 +1,310 @@
+"""
+智慧物料 ABC 分類 - 命令列批次工具
+
+不需開啟網頁介面，直接對 Excel / CSV 檔案（或整個資料夾）執行主分類與 ABC 分析：
+
+    python abc_cli.py 物料.xlsx --rules classification_rules.json -o output/
+    python abc_cli.py exports/ --sheet uservo2000 --jobs 8 -o output/
+    python abc_cli.py 年度明細.xlsx --jobs 8 -o output/            # 單一大型檔案分片平行處理
+    python abc_cli.py 每週異動.xlsx --ledger 月結.ledger --key-col 序號 -o output/
+
+規則檔使用網頁介面「匯出規則設定」下載的 JSON 格式；未指定時使用預設規則。
+結束代碼：0 成功、1 有檔案處理失敗、2 規則驗證失敗。
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from abc_core import (
+    ABC_THRESHOLDS,
+    DEFAULT_RULES,
+    AbcLedger,
+    ClassificationMemo,
+    ColumnMapping,
+    check_thresholds,
+    default_sheet_index_for,
+    find_rule_problems,
+    run_analysis,
+    run_analysis_chunked,
+)
+from abc_cache import get_sheet_cache, read_columns_cached, read_header_cached, read_sheet_cached
+from abc_io import XlsxStreamWriter, content_hash, export_frame, iter_chunks, list_sheet_names, read_header
+from abc_parallel import run_analysis_parallel
+
+SUPPORTED_SUFFIXES = {".xlsx", ".xls", ".csv"}
+
+def collect_input_files(paths):
+    """展開輸入路徑：資料夾取其中支援的檔案（依檔名排序）"""
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(p for p in path.iterdir() if p.suffix.lower() in SUPPORTED_SUFFIXES and not p.name.startswith("~$")))
+        else:
+            files.append(path)
+    return files
+
+def read_input(path, sheet_name=None, usecols=None, text_cols=(), sheet_cache=True):
+    """
+    讀取單一輸入檔，Excel 未指定工作表時依網頁介面相同的預設邏輯選擇
+    指定 usecols 時使用快速讀取模式，只讀取這些欄位
+    sheet_cache 為 True 時 Excel 使用與網頁介面共用的工作表快照（依檔案內容識別）
+    """
+    source, file_hash = path, None
+    cache = get_sheet_cache() if sheet_cache and path.suffix.lower() != ".csv" else None
+    if cache is not None:
+        source = path.read_bytes()
+        file_hash = content_hash(source)
+    if sheet_name is None and path.suffix.lower() != ".csv":
+        sheet_names = list_sheet_names(source)
+        sheet_name = sheet_names[default_sheet_index_for(sheet_names)]
+    if usecols is None:
+        return read_sheet_cached(cache, file_hash, source, sheet_name)
+    header = read_header_cached(cache, file_hash, source, sheet_name)
+    missing = [col for col in usecols if col not in header]
+    if missing:
+        raise ValueError(f"找不到欄位：{', '.join(map(str, missing))}")
+    return read_columns_cached(cache, file_hash, source, sheet_name, [col for col in header if col in usecols], text_cols)
+
+def write_output(df, path):
+    """依副檔名寫出結果（.csv、.parquet 或 .xlsx）"""
+    suffix = path.suffix.lower().lstrip(".")
+    export_frame(df, suffix if suffix in ("csv", "parquet") else "xlsx", target=str(path))
+
+class ChunkedOutput:
+    """分塊模式的輸出：依序附加每個區塊（CSV 直接附加；xlsx 以 constant_memory 模式逐列寫出）"""
+
+    def __init__(self, path):
+        if path.suffix.lower() == ".parquet":
+            raise ValueError("分塊模式不支援 Parquet 輸出，請改用 --format csv 或 xlsx")
+        self.path = path
+        self.rows_written = 0
+        self.xlsx_writer = None if path.suffix.lower() == ".csv" else XlsxStreamWriter(str(path))
+
+    def write(self, chunk):
+        if self.xlsx_writer is None:
+            first = self.rows_written == 0
+            chunk.to_csv(self.path, index=False, mode="w" if first else "a", header=first, encoding="utf-8-sig" if first else "utf-8")
+        else:
+            self.xlsx_writer.write_frame("分類結果", chunk)
+        self.rows_written += len(chunk)
+
+    def close(self):
+        if self.xlsx_writer is not None:
+            self.xlsx_writer.close()
+
+def output_path_for(input_path, output_dir, output_format):
+    suffix = input_path.suffix.lower() if output_format == "same" else f".{output_format}"
+    if suffix == ".xls":
+        suffix = ".xlsx"
+    return Path(output_dir) / f"{input_path.stem}_classified{suffix}"
+
+# 每個子行程一份分類備忘表，同一行程處理的多個檔案共用相同料號的分類結果
+MEMO = ClassificationMemo()
+
+def process_file_chunked(input_path, output_path, rules, columns, sheet_name, usecols, chunksize, thresholds=ABC_THRESHOLDS):
+    """分塊處理單一檔案，記憶體用量與區塊大小成正比，回傳 (筆數, 提示訊息)"""
+    if sheet_name is None and input_path.suffix.lower() != ".csv":
+        sheet_names = list_sheet_names(input_path)
+        sheet_name = sheet_names[default_sheet_index_for(sheet_names)]
+    header = read_header(input_path, sheet_name)
+    missing = [col for col in (usecols or (columns.prod_col, columns.currency_col, columns.qty_col, columns.price_col)) if col not in header]
+    if missing:
+        raise ValueError(f"找不到欄位：{', '.join(map(str, missing))}")
+
+    chunks = iter_chunks(input_path, sheet_name, chunksize, usecols, (columns.prod_col, columns.currency_col))
+    output = ChunkedOutput(output_path)
+    try:
+        diagnostics = run_analysis_chunked(
+            chunks, rules, columns, output.write, spill_dir=output_path.parent, memo=MEMO, thresholds=thresholds
+        )
+    finally:
+        output.close()
+    return output.rows_written, diagnostics.warnings
+
+def process_file(input_path, output_path, rules, columns, sheet_name=None, fast=False, keep_cols=(), chunksize=None, workers=None,
+                 thresholds=ABC_THRESHOLDS, sheet_cache=True):
+    """處理單一檔案（在子行程中執行），回傳 (筆數, 提示訊息)；指定 workers 時以多個行程平行處理這個檔案"""
+    usecols = None
+    if fast:
+        usecols = list(dict.fromkeys([columns.prod_col, columns.currency_col, columns.qty_col, columns.price_col, *keep_cols]))
+    if chunksize:
+        return process_file_chunked(input_path, output_path, rules, columns, sheet_name, usecols, chunksize, thresholds)
+    df = read_input(input_path, sheet_name, usecols, (columns.prod_col, columns.currency_col), sheet_cache)
+    missing = [col for col in (columns.prod_col, columns.currency_col, columns.qty_col, columns.price_col) if col not in df.columns]
+    if missing:
+        raise ValueError(f"找不到欄位：{', '.join(map(str, missing))}")
+    if workers:
+        result = run_analysis_parallel(df, rules, columns, workers, copy=False, thresholds=thresholds)
+    else:
+        result = run_analysis(df, rules, columns, copy=False, memo=MEMO, thresholds=thresholds)
+    write_output(result.frame, output_path)
+    return len(result.frame), result.diagnostics.warnings
+
+def process_ledger(files, args, rules, columns):
+    """
+    分類帳模式：依序把檔案套用到 --ledger 指定的分類帳（不存在時以第一個檔案建立），
+    每個檔案輸出套用後的完整結果與 ABC 類別有變動的資料（*_changes.csv），回傳失敗的檔案數
+    """
+    ledger_path = Path(args.ledger)
+    ledger = AbcLedger.load(ledger_path) if ledger_path.exists() else None
+    thresholds = args.thresholds or ABC_THRESHOLDS
+    if ledger is not None:
+        # 分類帳沿用建立時的門檻，指定不同的門檻需重新建立
+        if args.thresholds and tuple(args.thresholds) != tuple(ledger.thresholds):
+            print(f"分類帳的 ABC 門檻為 {ledger.thresholds}，與 --thresholds 不同，請重新建立分類帳", file=sys.stderr)
+            return len(files)
+        thresholds = ledger.thresholds
+    usecols = None
+    if args.fast:
+        usecols = list(dict.fromkeys([columns.prod_col, columns.currency_col, columns.qty_col, columns.price_col, *args.keep_col]))
+        if args.key_col:
+            usecols.append(args.key_col)
+    failed = 0
+    for path in files:
+        output_path = output_path_for(path, args.output_dir, args.format)
+        try:
+            df = read_input(path, args.sheet, usecols, (columns.prod_col, columns.currency_col), not args.no_sheet_cache)
+            if args.key_col:
+                if args.key_col not in df.columns:
+                    raise ValueError(f"找不到欄位：{args.key_col}")
+                df.index = df[args.key_col].to_numpy()
+            else:
+                # 沒有識別欄位時全部視為新增的資料
+                start = len(ledger.frame) if ledger is not None else 0
+                df.index = range(start, start + len(df))
+            result = run_analysis(df, rules, columns, copy=False, memo=MEMO, thresholds=thresholds)
+            if ledger is None:
+                ledger = AbcLedger(result.frame, thresholds)
+                changes = None
+            else:
+                changes = ledger.update(result.frame)
+            ledger.save(ledger_path)
+            write_output(ledger.frame, output_path)
+        except Exception as e:
+            failed += 1
+            print(f"✗ {path}：{e}", file=sys.stderr)
+            continue
+        print(f"✓ {path}：{len(result.frame)} 筆 → {output_path}（分類帳共 {len(ledger.frame)} 筆）")
+        if changes is not None:
+            changes_path = output_path.with_name(f"{path.stem}_changes.csv")
+            export_frame(changes.rename_axis(args.key_col or "列").reset_index(), "csv", target=str(changes_path))
+            print(f"  ABC 類別有變動：{len(changes)} 筆 → {changes_path}")
+        for message in result.diagnostics.warnings:
+            print(f"  {message}")
+    return failed
+
+def load_rules(path):
+    if path is None:
+        return DEFAULT_RULES
+    with open(path, encoding="utf-8") as f:
+        rules = json.load(f)
+    if not isinstance(rules, dict) or not all(isinstance(info, dict) for info in rules.values()):
+        raise ValueError("規則檔格式錯誤，應為「分類 → 規則設定」的物件")
+    return rules
+
+def parse_thresholds(text):
+    try:
+        return check_thresholds(text.split(","))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"格式為 A,B（例如 0.8,0.95）：{e}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="智慧物料 ABC 分類 - 命令列批次工具")
+    parser.add_argument("inputs", nargs="+", help="輸入的 Excel/CSV 檔案或資料夾")
+    parser.add_argument("-o", "--output-dir", default=".", help="輸出資料夾（預設為目前目錄）")
+    parser.add_argument("--rules", help="規則設定 JSON（網頁介面「匯出規則設定」的格式），預設使用系統預設規則")
+    parser.add_argument("--sheet", help="工作表名稱，預設依 uservo2000 → 分類物料 → 第一個工作表")
+    parser.add_argument("--prod-col", default="產品編號", help="產品編號欄位名稱")
+    parser.add_argument("--currency-col", default="幣別", help="幣別欄位名稱")
+    parser.add_argument("--qty-col", default="需求數", help="需求數欄位名稱")
+    parser.add_argument("--price-col", default="單價", help="單價欄位名稱")
+    parser.add_argument("--fast", action="store_true", help="快速讀取：只讀取四個對應欄位（及 --keep-col 指定的欄位）")
+    parser.add_argument("--keep-col", action="append", default=[], help="快速讀取時額外保留的欄位，可重複指定")
+    parser.add_argument("--no-sheet-cache", action="store_true", help="不使用工作表快照（每次重新解析 Excel）")
+    parser.add_argument("--chunk-size", type=int, help="分塊處理：每次只讀取指定列數（適用於大於記憶體的檔案）")
+    parser.add_argument(
+        "--thresholds", type=parse_thresholds,
+        help="ABC 門檻「A,B」（累計百分比，例如 0.8,0.95），預設 0.7,0.9"
+    )
+    parser.add_argument("--format", choices=["same", "xlsx", "csv", "parquet"], default="same", help="輸出格式，same 表示與輸入相同")
+    parser.add_argument("--ledger", help="分類帳檔案：依序把輸入檔套用到分類帳（不存在時以第一個檔案建立），只重算有異動的分類")
+    parser.add_argument("--key-col", help="分類帳模式下識別每一筆資料的欄位（如 序號），已存在的資料視為更新；未指定時全部視為新增")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="同時處理的檔案數（行程數）；只有一個檔案時改為以此行程數平行處理該檔案")
+    return parser
+
+def report_file(path, rows, warnings, args):
+    print(f"✓ {path}：{rows} 筆 → {output_path_for(path, args.output_dir, args.format)}")
+    for message in warnings:
+        print(f"  {message}")
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    try:
+        rules = load_rules(args.rules)
+    except (OSError, ValueError) as e:
+        print(f"規則檔讀取失敗：{e}", file=sys.stderr)
+        return 2
+    missing_rules, incomplete_rules = find_rule_problems(rules)
+    if missing_rules or incomplete_rules:
+        if missing_rules:
+            print(f"以下分類尚未設定規則：{', '.join(missing_rules)}", file=sys.stderr)
+        if incomplete_rules:
+            print(f"以下分類規則不完整：{', '.join(incomplete_rules)}", file=sys.stderr)
+        return 2
+
+    columns = ColumnMapping(args.prod_col, args.currency_col, args.qty_col, args.price_col)
+    files = collect_input_files(args.inputs)
+    if not files:
+        print("沒有找到可處理的檔案", file=sys.stderr)
+        return 1
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    if args.ledger:
+        if args.chunk_size:
+            print("分類帳模式不支援 --chunk-size", file=sys.stderr)
+            return 2
+        return 1 if process_ledger(files, args, rules, columns) else 0
+
+    if len(files) == 1 and args.jobs > 1 and not args.chunk_size:
+        # 單一大型檔案：在目前行程讀取，分片交給 abc_parallel 的行程池
+        path = files[0]
+        try:
+            rows, warnings = process_file(
+                path, output_path_for(path, args.output_dir, args.format),
+                rules, columns, args.sheet, args.fast, tuple(args.keep_col), workers=args.jobs,
+                thresholds=args.thresholds or ABC_THRESHOLDS, sheet_cache=not args.no_sheet_cache
+            )
+        except Exception as e:
+            print(f"✗ {path}：{e}", file=sys.stderr)
+            return 1
+        report_file(path, rows, warnings, args)
+        return 0
+
+    failed = 0
+    jobs = max(1, min(args.jobs, len(files)))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            path: pool.submit(
+                process_file, path, output_path_for(path, args.output_dir, args.format),
+                rules, columns, args.sheet, args.fast, tuple(args.keep_col), args.chunk_size,
+                thresholds=args.thresholds or ABC_THRESHOLDS, sheet_cache=not args.no_sheet_cache
+            )
+            for path in files
+        }
+        for path, future in futures.items():
+            try:
+                rows, warnings = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"✗ {path}：{e}", file=sys.stderr)
+                continue
+            report_file(path, rows, warnings, args)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
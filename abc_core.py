@@ -0,0 +1,1646 @@
+"""
+智慧物料 ABC 分類核心函式庫
+
+不依賴 Streamlit、不產生任何畫面輸出，可直接在批次作業或測試中匯入：
+
+    from abc_core import ColumnMapping, run_analysis
+    result = run_analysis(df, rules, ColumnMapping("產品編號", "幣別", "需求數", "單價"))
+    result.frame, result.diagnostics
+
+計算過程中的提示與統計都記錄在 Diagnostics，由呼叫端（網頁介面或命令列）決定如何呈現。
+"""
+import os
+import pickle
+import re
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from abc_perf import peak_rss_mb
+
+# --- 預設分類規則 ---
+DEFAULT_RULES = {
+    "進口": {
+        "condition_type": "currency",
+        "rule": "not_ntd",
+        "description": "幣別不是NTD的項目"
+    },
+    "板金": {
+        "condition_type": "product_code",
+        "rule": "startswith_4KB_and_contains_P",
+        "description": "產品編號以4KB開頭且包含P"
+    },
+    "加工件": {
+        "condition_type": "product_code", 
+        "rule": "startswith_4KB_contains_MHSLK_or_startswith_kb",
+        "description": "產品編號以4KB開頭包含M/H/S/L/K，或以KB開頭"
+    },
+    "電料": {
+        "condition_type": "product_code",
+        "rule": "startswith_4KZ", 
+        "description": "產品編號以4KZ開頭"
+    },
+    "市購件": {
+        "condition_type": "product_code",
+        "rule": "startswith_4SS",
+        "description": "產品編號以4SS開頭"
+    }
+}
+
+FIXED_CATEGORIES = ["進口", "板金", "加工件", "電料", "市購件"]
+DOMESTIC_CATEGORIES = ["板金", "加工件", "電料", "市購件"]
+
+# 分類結果中保留的名稱，不可作為自訂分類
+RESERVED_CATEGORIES = ["其他", "錯誤"]
+CODE_LIST_KEYS = ("prefixes", "suffixes", "contains")
+
+def is_rule_incomplete(rule_info):
+    if rule_info.get("condition_type") == "code_lists":
+        return not any(rule_info.get(key) for key in CODE_LIST_KEYS)
+    return not rule_info.get("rule") or rule_info["rule"] == "custom"
+
+def find_rule_problems(rules):
+    """檢查規則完整性，回傳 (未設定的分類, 規則不完整的分類)；自訂分類也會檢查是否不完整"""
+    missing_rules = []
+    incomplete_rules = []
+    for category in FIXED_CATEGORIES:
+        if category not in rules:
+            missing_rules.append(category)
+    for category, rule_info in rules.items():
+        if category in RESERVED_CATEGORIES or is_rule_incomplete(rule_info):
+            incomplete_rules.append(category)
+    return missing_rules, incomplete_rules
+
+PREFERRED_SHEETS = ["uservo2000", "分類物料"]
+
+def default_sheet_index_for(sheet_names):
+    """預設工作表：優先 uservo2000，其次 分類物料，否則第一個"""
+    for name in PREFERRED_SHEETS:
+        if name in sheet_names:
+            return sheet_names.index(name)
+    return 0
+
+# --- 規則編譯：將規則字串轉為可重複使用的比對物件 ---
+class RuleMatcher:
+    """已編譯規則的共同介面：match 逐筆比對，mask 整欄比對"""
+
+    def match(self, prod_code, currency):
+        raise NotImplementedError
+
+    def mask(self, prod_codes, currencies):
+        raise NotImplementedError
+
+@dataclass(frozen=True)
+class NeverMatcher(RuleMatcher):
+    """無法辨識的規則：永遠不符合"""
+
+    def match(self, prod_code, currency):
+        return False
+
+    def mask(self, prod_codes, currencies):
+        return pd.Series(False, index=prod_codes.index)
+
+@dataclass(frozen=True)
+class BrokenMatcher(RuleMatcher):
+    """格式錯誤的規則：比對時拋出錯誤，分類結果為「錯誤」"""
+    error: str
+
+    def match(self, prod_code, currency):
+        raise ValueError(self.error)
+
+    def mask(self, prod_codes, currencies):
+        raise ValueError(self.error)
+
+@dataclass(frozen=True)
+class CurrencyMatcher(RuleMatcher):
+    """幣別規則：幣別是否在清單中（negate 為 True 時為不在清單中）"""
+    currencies: frozenset
+    negate: bool = False
+
+    def match(self, prod_code, currency):
+        return (currency in self.currencies) != self.negate
+
+    def mask(self, prod_codes, currencies):
+        result = currencies.isin(self.currencies)
+        return ~result if self.negate else result
+
+@dataclass(frozen=True)
+class PrefixMatcher(RuleMatcher):
+    """產品編號以任一前綴開頭"""
+    prefixes: tuple
+
+    def match(self, prod_code, currency):
+        return prod_code.startswith(self.prefixes)
+
+    def mask(self, prod_codes, currencies):
+        return prod_codes.str.startswith(self.prefixes)
+
+@dataclass(frozen=True)
+class SuffixMatcher(RuleMatcher):
+    """產品編號以指定字串結尾"""
+    suffix: str
+
+    def match(self, prod_code, currency):
+        return prod_code.endswith(self.suffix)
+
+    def mask(self, prod_codes, currencies):
+        return prod_codes.str.endswith(self.suffix)
+
+@dataclass(frozen=True)
+class ContainsMatcher(RuleMatcher):
+    """產品編號包含（negate 為 True 時為不包含）指定字串"""
+    substring: str
+    negate: bool = False
+
+    def match(self, prod_code, currency):
+        return (self.substring in prod_code) != self.negate
+
+    def mask(self, prod_codes, currencies):
+        result = prod_codes.str.contains(self.substring, regex=False)
+        return ~result if self.negate else result
+
+@dataclass(frozen=True)
+class CompoundMatcher(RuleMatcher):
+    """複合條件：開頭條件 AND/OR 包含條件（完整字串或任一字元）"""
+    logic: str
+    prefix: str
+    substring: str = ""
+    chars: frozenset = None
+
+    def match(self, prod_code, currency):
+        prefix_match = prod_code.startswith(self.prefix)
+        if self.chars is not None:
+            contains_match = any(char in prod_code for char in self.chars)
+        else:
+            contains_match = self.substring in prod_code
+        if self.logic == "AND":
+            return prefix_match and contains_match
+        return prefix_match or contains_match
+
+    def mask(self, prod_codes, currencies):
+        prefix_match = prod_codes.str.startswith(self.prefix)
+        if self.chars is not None:
+            if self.chars:
+                char_class = "[" + "".join(re.escape(char) for char in sorted(self.chars)) + "]"
+                contains_match = prod_codes.str.contains(char_class, regex=True)
+            else:
+                contains_match = pd.Series(False, index=prod_codes.index)
+        else:
+            contains_match = prod_codes.str.contains(self.substring, regex=False)
+        if self.logic == "AND":
+            return prefix_match & contains_match
+        return prefix_match | contains_match
+
+@dataclass(frozen=True)
+class AnyMatcher(RuleMatcher):
+    """任一子規則符合即符合"""
+    matchers: tuple
+
+    def match(self, prod_code, currency):
+        return any(matcher.match(prod_code, currency) for matcher in self.matchers)
+
+    def mask(self, prod_codes, currencies):
+        result = pd.Series(False, index=prod_codes.index)
+        for matcher in self.matchers:
+            result |= matcher.mask(prod_codes, currencies)
+        return result
+
+@dataclass(frozen=True)
+class CodeListMatcher(RuleMatcher):
+    """編碼清單：產品編號以任一前綴開頭、以任一後綴結尾，或包含任一字串"""
+    prefixes: tuple = ()
+    suffixes: tuple = ()
+    substrings: tuple = ()
+
+    def match(self, prod_code, currency):
+        return (
+            prod_code.startswith(self.prefixes)
+            or prod_code.endswith(self.suffixes)
+            or any(substring in prod_code for substring in self.substrings)
+        )
+
+    def mask(self, prod_codes, currencies):
+        return pd.Series(CodeListIndex([self]).ranks(prod_codes) == 0, index=prod_codes.index)
+
+NO_MATCH = np.iinfo(np.int32).max
+
+class AhoCorasick:
+    """
+    多字串比對自動機：一次掃描產品編號即可找出所有包含的字串
+    失敗連結在建立時展開為完整的轉移表，掃描時每個字元只需查表一次；
+    每個狀態記錄「經由失敗連結可達的所有字串」中最小的分類順位，掃描時只需取最小值；
+    另記錄這些字串的所有分類順位，供批次測試一次取得每個產品編號符合的所有分類
+    """
+
+    def __init__(self, patterns):
+        """patterns：{字串: 分類順位的 frozenset}"""
+        goto = [{}]
+        best = [NO_MATCH]
+        outputs = [frozenset()]
+        for pattern, ranks in patterns.items():
+            state = 0
+            for char in pattern:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    best.append(NO_MATCH)
+                    outputs.append(frozenset())
+                state = next_state
+            best[state] = min(best[state], min(ranks))
+            outputs[state] = outputs[state] | ranks
+
+        # 依深度展開：狀態的轉移表 = 失敗狀態的轉移表 + 自己的轉移
+        fail = [0] * len(goto)
+        self.delta = delta = [None] * len(goto)
+        delta[0] = dict(goto[0])
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            delta[state] = {**delta[fail[state]], **goto[state]}
+            for char, next_state in goto[state].items():
+                fail[next_state] = delta[fail[state]].get(char, 0) if state else 0
+                best[next_state] = min(best[next_state], best[fail[next_state]])
+                if outputs[fail[next_state]]:
+                    outputs[next_state] = outputs[next_state] | outputs[fail[next_state]]
+                queue.append(next_state)
+        self.best = best
+        self.outputs = outputs
+
+    def search(self, text):
+        """回傳 text 中包含的字串的最小分類順位（沒有則為 NO_MATCH）"""
+        delta, best = self.delta, self.best
+        state = 0
+        result = NO_MATCH
+        for char in text:
+            state = delta[state].get(char, 0)
+            if best[state] < result:
+                result = best[state]
+        return result
+
+    def search_all(self, text):
+        """回傳 text 中包含的字串的所有分類順位（set）"""
+        delta, outputs = self.delta, self.outputs
+        state = 0
+        result = set()
+        for char in text:
+            state = delta[state].get(char, 0)
+            if outputs[state]:
+                result |= outputs[state]
+        return result
+
+def build_trie(patterns):
+    """前綴樹：{字元: 子節點}，節點的 None 鍵記錄以此結尾的字串的最小分類順位"""
+    root = {}
+    for pattern, rank in patterns.items():
+        node = root
+        for char in pattern:
+            node = node.setdefault(char, {})
+        node[None] = min(node.get(None, NO_MATCH), rank)
+    return root
+
+def trie_matches(root, chars):
+    """沿字元走訪前綴樹，產生路徑上各字串的長度"""
+    node = root
+    for depth, char in enumerate(chars, 1):
+        node = node.get(char)
+        if node is None:
+            return
+        if None in node:
+            yield depth
+
+def walk_trie(root, chars, result):
+    """沿字元走訪前綴樹，回傳 result 與路徑上各字串順位中的最小值"""
+    node = root
+    for char in chars:
+        node = node.get(char)
+        if node is None:
+            break
+        rank = node.get(None, NO_MATCH)
+        if rank < result:
+            result = rank
+    return result
+
+class CodeListIndex:
+    """
+    所有編碼清單規則的共用索引，每個產品編號只掃描一次，比對成本與規則數量無關：
+    - 前綴：前綴樹；後綴：反轉字串的前綴樹
+    - 包含字串：Aho-Corasick 自動機
+    同一字串出現在多個分類時，分類只取順位最小（優先）者；all_ranks 則回傳所有符合的分類
+    """
+
+    def __init__(self, matchers):
+        """matchers：依分類優先順序排列的 CodeListMatcher（不適用的位置可為 None），比對字串不可為空字串"""
+        prefixes, suffixes, substrings = {}, {}, {}
+        for rank, matcher in enumerate(matchers):
+            if matcher is None:
+                continue
+            for patterns, values in ((prefixes, matcher.prefixes), (suffixes, matcher.suffixes), (substrings, matcher.substrings)):
+                for pattern in values:
+                    patterns.setdefault(pattern, set()).add(rank)
+        self.prefix_ranks = {pattern: frozenset(ranks) for pattern, ranks in prefixes.items()}
+        self.suffix_ranks = {pattern[::-1]: frozenset(ranks) for pattern, ranks in suffixes.items()}
+        self.prefix_trie = build_trie({pattern: min(ranks) for pattern, ranks in self.prefix_ranks.items()})
+        self.suffix_trie = build_trie({pattern: min(ranks) for pattern, ranks in self.suffix_ranks.items()})
+        self.automaton = AhoCorasick({pattern: frozenset(ranks) for pattern, ranks in substrings.items()}) if substrings else None
+
+    def rank(self, prod_code):
+        """單一產品編號符合的最小分類順位（不符合為 NO_MATCH）"""
+        result = walk_trie(self.prefix_trie, prod_code, NO_MATCH)
+        result = walk_trie(self.suffix_trie, reversed(prod_code), result)
+        if self.automaton is not None:
+            result = min(result, self.automaton.search(prod_code))
+        return result
+
+    def ranks(self, prod_codes):
+        """整欄（已正規化的字串）的最小分類順位陣列"""
+        return np.fromiter(map(self.rank, prod_codes.tolist()), dtype=np.int64, count=len(prod_codes))
+
+    def all_ranks(self, prod_code):
+        """單一產品編號符合的所有分類順位（set）"""
+        result = set()
+        for depth in trie_matches(self.prefix_trie, prod_code):
+            result |= self.prefix_ranks[prod_code[:depth]]
+        reversed_code = prod_code[::-1]
+        for depth in trie_matches(self.suffix_trie, reversed_code):
+            result |= self.suffix_ranks[reversed_code[:depth]]
+        if self.automaton is not None:
+            result |= self.automaton.search_all(prod_code)
+        return result
+
+@dataclass(frozen=True)
+class CompiledRules:
+    """依分類優先順序排列的已編譯規則（可雜湊，可作為快取鍵）；code_index 為編碼清單規則的共用索引"""
+    entries: tuple
+    code_index: CodeListIndex = field(default=None, compare=False, hash=False, repr=False)
+
+    def __contains__(self, category):
+        return any(name == category for name, _ in self.entries)
+
+    def __getitem__(self, category):
+        for name, matcher in self.entries:
+            if name == category:
+                return matcher
+        raise KeyError(category)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+def clean_code_list(values):
+    """編碼清單：接受清單或以逗號／換行分隔的字串，去空白、轉大寫並移除空白與重複項目"""
+    if isinstance(values, str):
+        values = re.split(r"[,\n]", values)
+    return tuple(dict.fromkeys(str(value).strip().upper() for value in values if str(value).strip()))
+
+def compile_rule(rule_info):
+    """將單一規則（condition_type + rule 字串，或 code_lists 編碼清單）編譯為比對物件"""
+    try:
+        if rule_info["condition_type"] == "code_lists":
+            return CodeListMatcher(*(clean_code_list(rule_info.get(key) or ()) for key in CODE_LIST_KEYS))
+    except Exception as e:
+        return BrokenMatcher(f"規則格式錯誤：{e!r}")
+    try:
+        condition_type = rule_info["condition_type"]
+        rule = rule_info["rule"]
+    except Exception as e:
+        return BrokenMatcher(f"規則格式錯誤：{e!r}")
+
+    if condition_type == "currency":
+        if rule == "not_ntd":
+            return CurrencyMatcher(frozenset({"NTD", "NAN", ""}), negate=True)
+        if not isinstance(rule, str):
+            return BrokenMatcher(f"規則必須為字串：{rule!r}")
+        if rule.startswith("equals_"):
+            return CurrencyMatcher(frozenset({rule.replace("equals_", "").upper()}))
+        elif rule.startswith("not_equals_"):
+            return CurrencyMatcher(frozenset({rule.replace("not_equals_", "").upper()}), negate=True)
+        elif rule.startswith("in_list_"):
+            currency_list = rule.replace("in_list_", "").split(",")
+            return CurrencyMatcher(frozenset(c.upper() for c in currency_list))
+        elif rule.startswith("not_in_list_"):
+            currency_list = rule.replace("not_in_list_", "").split(",")
+            return CurrencyMatcher(frozenset(c.upper() for c in currency_list), negate=True)
+        return NeverMatcher()
+
+    elif condition_type == "product_code":
+        # 板金規則：4KB開頭 + 任一位置含P
+        if rule == "startswith_4KB_and_contains_P":
+            return CompoundMatcher("AND", "4KB", substring="P")
+        # 加工件規則：4KB開頭加特殊字元，或純KB開頭
+        elif rule == "startswith_4KB_contains_MHSLK_or_startswith_kb":
+            return AnyMatcher((
+                CompoundMatcher("AND", "4KB", chars=frozenset("MHSLK")),
+                PrefixMatcher(("KB",)),
+            ))
+        if not isinstance(rule, str):
+            return BrokenMatcher(f"規則必須為字串：{rule!r}")
+        if rule.startswith("startswith_"):
+            return PrefixMatcher((rule.replace("startswith_", "").upper(),))
+        elif rule.startswith("endswith_"):
+            return SuffixMatcher(rule.replace("endswith_", "").upper())
+        elif rule.startswith("contains_"):
+            return ContainsMatcher(rule.replace("contains_", "").upper())
+        elif rule.startswith("not_contains_"):
+            return ContainsMatcher(rule.replace("not_contains_", "").upper(), negate=True)
+        elif rule.startswith("compound_"):
+            # 處理複合條件：compound_AND/OR_prefix_contains_[type]（相容沒有 type 的舊格式）
+            parts = rule.split("_")
+            if len(parts) >= 4:
+                logic = parts[1].upper()
+                if logic not in ("AND", "OR"):
+                    return NeverMatcher()
+                prefix_condition = parts[2].upper()
+                contains_condition = parts[3].upper()
+                if len(parts) >= 5 and parts[4].lower() == "anychar":
+                    return CompoundMatcher(logic, prefix_condition, chars=frozenset(contains_condition))
+                return CompoundMatcher(logic, prefix_condition, substring=contains_condition)
+        return NeverMatcher()
+
+    return NeverMatcher()
+
+def ordered_categories(rules):
+    """分類優先順序：進口 → 板金 → 加工件 → 電料 → 市購件 → 其餘自訂分類（依設定順序）"""
+    fixed = (["進口"] if "進口" in rules else []) + [c for c in DOMESTIC_CATEGORIES if c in rules]
+    return fixed + [c for c in rules if c not in FIXED_CATEGORIES and c not in RESERVED_CATEGORIES]
+
+def compile_rules(rules):
+    """將整組規則依優先順序編譯，每次執行只需編譯一次；編碼清單規則另建共用索引"""
+    if isinstance(rules, CompiledRules):
+        return rules
+    entries = tuple((category, compile_rule(rules[category])) for category in ordered_categories(rules))
+    code_lists = [matcher if isinstance(matcher, CodeListMatcher) else None for _, matcher in entries]
+    code_index = CodeListIndex(code_lists) if any(code_lists) else None
+    return CompiledRules(entries, code_index)
+
+# --- 規則檢查 ---
+def check_rule(prod_code, currency, rule_info):
+    """檢查單一規則是否符合 - 接受規則設定或已編譯的比對物件"""
+    matcher = rule_info if isinstance(rule_info, RuleMatcher) else compile_rule(rule_info)
+    return matcher.match(str(prod_code).upper(), currency)
+
+def parse_test_codes(text):
+    """批次測試的貼上內容：每行一筆「產品編號,幣別」（逗號或 Tab 分隔，幣別可省略），回傳 (產品編號, 幣別) 兩個 Series"""
+    lines = pd.Series([line for line in text.splitlines() if line.strip()], dtype=object)
+    fields = lines.str.split(r"[,\t]", n=1, regex=True)
+    return fields.str[0].str.strip(), fields.str[1].fillna("").str.strip()
+
+@dataclass
+class RuleCoverage:
+    """
+    批次測試結果
+    hits：各規則的符合筆數、最終分類筆數、被優先順序較前的規則取走的筆數與占比
+    overlap：分類 × 分類，同時符合兩條規則的筆數（對角線為符合筆數）；非對角線的資料由優先順序決定分類
+    unmatched：未符合任何規則（歸為「其他」）的 (產品編號, 幣別) 與筆數，依筆數由多到少
+    labels：每列的最終分類（與實際分類相同）
+    """
+    hits: pd.DataFrame
+    overlap: pd.DataFrame
+    unmatched: pd.DataFrame
+    labels: pd.Series
+
+def rule_coverage(rules, prod_codes, currencies, diagnostics=None):
+    """
+    對整欄產品編號與幣別一次評估所有規則：每條規則只對相異的 (產品編號, 幣別) 組合整欄比對，
+    所有編碼清單規則則以共用索引掃描一次，取得每個產品編號符合的所有分類；
+    再以各組合的筆數加權，得到符合筆數與重疊矩陣；最終分類與 classify_columns 相同
+    """
+    compiled = compile_rules(rules)
+    pair_codes, unique_prods, unique_currencies = factorize_pairs(prod_codes, currencies)
+    weights = np.bincount(pair_codes, minlength=len(unique_prods)).astype(np.int64)
+    prods, currency_values = pd.Series(unique_prods), pd.Series(unique_currencies)
+
+    categories = [category for category, _ in compiled]
+    masks = np.zeros((len(unique_prods), len(categories)), dtype=bool)
+    if compiled.code_index is not None:
+        # 相同產品編號（幣別不同）只掃描一次；符合的分類組合種類不多，每種組合只展開一次遮罩
+        code_index, code_values = pd.factorize(prods)
+        rank_sets = {}
+        set_ids = np.fromiter(
+            (rank_sets.setdefault(frozenset(compiled.code_index.all_ranks(prod_code)), len(rank_sets)) for prod_code in code_values),
+            dtype=np.int64, count=len(code_values),
+        )
+        set_masks = np.zeros((len(rank_sets), len(categories)), dtype=bool)
+        for rank_set, set_id in rank_sets.items():
+            set_masks[set_id, list(rank_set)] = True
+        masks = set_masks[set_ids[code_index]]
+    broken = None
+    for position, (category, matcher) in enumerate(compiled):
+        if compiled.code_index is not None and isinstance(matcher, CodeListMatcher):
+            continue
+        try:
+            masks[:, position] = matcher.mask(prods, currency_values).to_numpy(dtype=bool)
+        except Exception as e:
+            # 與 evaluate_rules 相同：第一條有誤的規則之後尚未分類的資料為「錯誤」，該規則視為沒有符合的資料
+            if broken is None:
+                broken = position
+                if diagnostics is not None:
+                    diagnostics.warn(f"分類處理錯誤：{e}")
+
+    # 最終分類：依優先順序第一條符合的規則
+    first = np.full(len(masks), len(categories), dtype=np.int64)
+    if categories:
+        any_match = masks.any(axis=1)
+        first[any_match] = masks[any_match].argmax(axis=1)
+    names = categories + ["其他"]
+    if broken is not None:
+        np.minimum(first, broken, out=first)
+        names[broken] = "錯誤"
+    unique_labels = np.array(names, dtype=object).take(first)
+
+    # overlap[i, j] = Σ 組合筆數 × (符合規則 i) × (符合規則 j)；符合情形相同的組合先合併，只對相異的遮罩列相乘
+    packed = np.packbits(masks, axis=1)
+    row_keys = packed.view(np.dtype((np.void, packed.shape[1]))).ravel() if packed.shape[1] else np.zeros(len(masks))
+    _, first_rows, inverse = np.unique(row_keys, return_index=True, return_inverse=True)
+    counts = masks[first_rows].astype(np.int64)
+    group_weights = np.bincount(inverse.ravel(), weights=weights, minlength=len(first_rows)).astype(np.int64)
+    overlap = pd.DataFrame((counts.T * group_weights) @ counts, index=categories, columns=categories)
+    matched = np.diag(overlap.to_numpy())
+    assigned = pd.Series(weights).groupby(unique_labels).sum()
+    hits = pd.DataFrame({
+        "分類": categories,
+        "符合筆數": matched,
+        "最終分類筆數": [int(assigned.get(category, 0)) for category in categories],
+    })
+    hits["被優先規則取走"] = hits["符合筆數"] - hits["最終分類筆數"]
+    total = int(weights.sum())
+    hits["最終分類占比"] = hits["最終分類筆數"] / total if total else 0.0
+
+    other = np.flatnonzero(unique_labels == "其他")
+    unmatched = pd.DataFrame({
+        "產品編號": unique_prods[other],
+        "幣別": unique_currencies[other],
+        "筆數": weights[other],
+    }).sort_values("筆數", ascending=False, kind="stable").reset_index(drop=True)
+    labels = pd.Series(unique_labels[pair_codes], index=prod_codes.index, dtype=object)
+    return RuleCoverage(hits, overlap, unmatched, labels)
+
+# --- 向量化分類引擎 ---
+def normalize_text_column(series, upper=False):
+    """整欄轉為去空白字串，空值轉為空字串（與 classify_row 的逐筆處理相同）"""
+    # 快速讀取模式下產品編號與幣別已是字串，不需逐筆轉換
+    text = series if pd.api.types.infer_dtype(series, skipna=True) == "string" else series.astype(str)
+    text = text.str.strip()
+    if upper:
+        text = text.str.upper()
+    return text.where(series.notna(), "")
+
+def factorize_text_column(series, upper=False):
+    """
+    整欄正規化後編碼：回傳 (codes, uniques)，uniques[codes] 等於 normalize_text_column 的結果
+    去空白、轉大寫只對相異值執行一次
+    """
+    text = series if pd.api.types.infer_dtype(series, skipna=True) == "string" else series.astype(str)
+    codes, uniques = pd.factorize(text.where(series.notna(), ""))
+    normalized = normalize_text_column(pd.Series(uniques), upper=upper)
+    # 正規化後可能有重複（如 "ab" 與 " AB "），再編碼一次
+    unique_codes, uniques = pd.factorize(normalized)
+    return unique_codes[codes], uniques.array
+
+def factorize_pairs(prod_codes, currencies):
+    """將正規化後的 (產品編號, 幣別) 組合編碼：回傳 (每列的組合代碼, 相異產品編號, 相異幣別)"""
+    prod_index, prod_uniques = factorize_text_column(prod_codes, upper=True)
+    currency_index, currency_uniques = factorize_text_column(currencies, upper=True)
+    currency_count = max(len(currency_uniques), 1)
+    pair_codes, pair_uniques = pd.factorize(prod_index.astype(np.int64) * currency_count + currency_index)
+    pair_uniques = np.asarray(pair_uniques, dtype=np.int64)
+    return pair_codes, prod_uniques[pair_uniques // currency_count], currency_uniques[pair_uniques % currency_count]
+
+def evaluate_rules(compiled, prod_codes, currencies, diagnostics=None):
+    """
+    對已正規化的欄位逐條評估已編譯規則，每列保留符合的最小分類順位，最後一次查表得到分類
+    編碼清單規則由共用索引直接給出順位，不需為每個分類建立整欄遮罩；回傳 (分類陣列, 是否發生錯誤)
+    """
+    names = [category for category, _ in compiled]
+    failed = False
+    # 所有編碼清單規則共用一次索引查詢
+    if compiled.code_index is not None:
+        best = compiled.code_index.ranks(prod_codes)
+    else:
+        best = np.full(len(prod_codes), NO_MATCH, dtype=np.int64)
+    for rank, (category, matcher) in enumerate(compiled):
+        if compiled.code_index is not None and isinstance(matcher, CodeListMatcher):
+            continue
+        try:
+            mask = matcher.mask(prod_codes, currencies).to_numpy(dtype=bool)
+        except Exception as e:
+            # 規則本身有誤時，尚未分類的資料全部標記為「錯誤」（與逐筆處理相同）
+            if diagnostics is not None:
+                diagnostics.warn(f"分類處理錯誤：{e}")
+            np.minimum(best, rank, out=best)
+            names[rank] = "錯誤"
+            failed = True
+            break
+        np.minimum(best, rank, out=best, where=mask)
+
+    best[best == NO_MATCH] = len(names)
+    return np.array(names + ["其他"], dtype=object).take(best), failed
+
+class ClassificationMemo:
+    """
+    分類結果備忘表：依已編譯規則記錄 (產品編號, 幣別) → 分類，規則不變時重新執行只需分類新出現的組合
+    只保留最近使用的 max_rule_sets 組規則
+    """
+
+    def __init__(self, max_rule_sets=4):
+        self.max_rule_sets = max_rule_sets
+        self.tables = {}
+
+    def lookup(self, compiled, prod_codes, currencies):
+        """回傳已知分類（未知為 None）的陣列"""
+        table = self.tables.get(compiled)
+        if table is None:
+            return np.full(len(prod_codes), None, dtype=object)
+        # 重新插入，維持最近使用順序
+        self.tables[compiled] = self.tables.pop(compiled)
+        keys = pd.MultiIndex.from_arrays([prod_codes, currencies])
+        return table.reindex(keys).to_numpy(dtype=object, copy=True)
+
+    def store(self, compiled, prod_codes, currencies, labels):
+        if len(labels) == 0:
+            return
+        new = pd.Series(labels, index=pd.MultiIndex.from_arrays([prod_codes, currencies]), dtype=object)
+        table = self.tables.pop(compiled, None)
+        self.tables[compiled] = new if table is None else pd.concat([table, new])
+        while len(self.tables) > self.max_rule_sets:
+            del self.tables[next(iter(self.tables))]
+
+    def clear(self):
+        self.tables.clear()
+
+def classify_columns(prod_codes, currencies, rules, diagnostics=None, memo=None):
+    """
+    整欄分類：只對相異的 (產品編號, 幣別) 組合評估規則，再以組合代碼對應回每一列
+    順序：進口 → 板金 → 加工件 → 電料 → 市購件，皆不符合為「其他」
+    傳入 ClassificationMemo 時，已分類過的組合直接沿用
+    """
+    compiled = compile_rules(rules)
+    pair_codes, unique_prods, unique_currencies = factorize_pairs(prod_codes, currencies)
+    unique_labels, _ = classify_pairs(compiled, unique_prods, unique_currencies, diagnostics, memo)
+    return pd.Series(unique_labels[pair_codes], index=prod_codes.index, dtype=object)
+
+def classify_pairs(compiled, unique_prods, unique_currencies, diagnostics=None, memo=None):
+    """對相異的 (產品編號, 幣別) 組合分類，回傳 (分類陣列, 是否發生錯誤)；傳入 memo 時只評估新出現的組合"""
+    if memo is None:
+        return evaluate_rules(compiled, pd.Series(unique_prods), pd.Series(unique_currencies), diagnostics)
+
+    unique_labels = memo.lookup(compiled, unique_prods, unique_currencies)
+    missing = np.flatnonzero(pd.isna(unique_labels))
+    failed = False
+    if len(missing):
+        labels, failed = evaluate_rules(
+            compiled,
+            pd.Series(unique_prods[missing]),
+            pd.Series(unique_currencies[missing]),
+            diagnostics,
+        )
+        unique_labels[missing] = labels
+        # 規則錯誤時不記錄，下次執行仍會產生警告
+        if not failed:
+            memo.store(compiled, unique_prods[missing], unique_currencies[missing], labels)
+    return unique_labels, failed
+
+# --- 除錯追蹤 ---
+TRACE_COLUMNS = ["列", "產品編號", "幣別", "順序", "規則", "說明", "結果", "分類"]
+
+class RuleTrace:
+    """
+    除錯用的規則比對追蹤：只對抽樣的資料（前 sample_size 筆，以及產品編號在 prod_codes 中的資料，最多 max_rows 筆）
+    依優先順序逐條比對規則，每次比對記錄為一筆 tuple，最後以 frame() 一次輸出為表格
+        trace = RuleTrace(sample_size=5, prod_codes=["4K1234"])
+        trace.record(compiled, df[prod_col], df[currency_col], df['分類'])
+        trace.frame()
+    分類本身仍由整欄分類完成，這裡只重現抽樣資料的比對過程；不追蹤時不需建立，沒有額外成本
+    """
+
+    def __init__(self, sample_size=5, prod_codes=(), max_rows=200):
+        self.sample_size = sample_size
+        self.prod_codes = frozenset(clean_code_list(prod_codes))
+        self.max_rows = max_rows
+        self.records = []
+
+    def positions(self, prod_codes):
+        """要追蹤的列位置（依原始順序）"""
+        positions = np.arange(min(self.sample_size, len(prod_codes)))
+        if self.prod_codes:
+            codes, uniques = factorize_text_column(prod_codes, upper=True)
+            wanted = np.flatnonzero(pd.Index(uniques).isin(self.prod_codes))
+            positions = np.union1d(positions, np.flatnonzero(np.isin(codes, wanted)))
+        return positions[:self.max_rows]
+
+    def record(self, compiled, prod_codes, currencies, labels, descriptions=None):
+        """重現抽樣資料的逐條比對；labels 為整欄分類的結果，descriptions 為 {分類: 規則說明}"""
+        compiled = compile_rules(compiled)
+        descriptions = descriptions or {}
+        positions = self.positions(prod_codes)
+        prods = normalize_text_column(prod_codes.iloc[positions], upper=True).tolist()
+        currencies = normalize_text_column(currencies.iloc[positions], upper=True).tolist()
+        labels = labels.iloc[positions].tolist()
+        for position, prod, currency, label in zip(positions.tolist(), prods, currencies, labels):
+            for rank, (category, matcher) in enumerate(compiled, start=1):
+                try:
+                    result = "✅ 符合" if matcher.match(prod, currency) else "❌"
+                except Exception as e:
+                    result = f"⚠️ {e}"
+                self.records.append((position + 1, prod, currency, rank, category, descriptions.get(category, ""), result, label))
+                if result != "❌":
+                    break
+        return self
+
+    def frame(self):
+        return pd.DataFrame.from_records(self.records, columns=TRACE_COLUMNS)
+
+# --- 數值清理 ---
+NUMERIC_PLACEHOLDERS = frozenset(['', '-', 'n/a', 'na', 'tbd', '待定', 'nan', 'null', '#n/a'])
+NUMERIC_NOISE_PATTERN = r"[,$￥€ \t\n]"   # 千分位、貨幣符號、空白
+SIMPLE_NUMBER_PATTERN = r"[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?"
+FIRST_NUMBER_PATTERN = re.compile(r'-?\d+\.?\d*')
+
+def clean_numeric_value(value):
+    """清理單一數值，處理常見的格式問題"""
+    if pd.isna(value):
+        return 0
+
+    # 轉為字串並移除常見的非數字字符
+    str_value = re.sub(NUMERIC_NOISE_PATTERN, '', str(value).strip())
+
+    # 處理特殊值
+    if str_value.lower() in NUMERIC_PLACEHOLDERS:
+        return 0
+
+    # 處理百分比
+    if str_value.endswith('%'):
+        return parse_number_text(str_value[:-1], extract=False) / 100
+
+    return parse_number_text(str_value, extract=True)
+
+def parse_number_text(text, extract=True):
+    """將已清理的字串轉為數字；無法轉換時視 extract 提取第一個數字或回傳 0"""
+    try:
+        return float(text)
+    except ValueError:
+        if extract:
+            numbers = FIRST_NUMBER_PATTERN.findall(text)
+            if numbers:
+                return float(numbers[0])
+        return 0
+
+def parse_number_column(text, extract=True):
+    """
+    整欄版本的 parse_number_text
+    一般數字格式直接以 float 轉換，其餘少數特殊字串才逐一（依唯一值）處理
+    """
+    values = np.zeros(len(text))
+    if len(text) == 0:
+        return values
+
+    simple = text.str.fullmatch(SIMPLE_NUMBER_PATTERN).to_numpy(dtype=bool)
+    values[simple] = np.asarray(text[simple], dtype=object).astype(float)
+
+    if not simple.all():
+        others = text[~simple]
+        uniques = others.unique()
+        parsed = {value: parse_number_text(value, extract) for value in uniques}
+        values[~simple] = others.map(parsed).to_numpy(dtype=float)
+    return values
+
+def clean_numeric_text(text):
+    """對字串欄位（不含空值）執行 clean_numeric_value 的清理規則"""
+    text = text.str.strip().str.replace(NUMERIC_NOISE_PATTERN, '', regex=True)
+    placeholder = text.str.lower().isin(NUMERIC_PLACEHOLDERS).to_numpy(dtype=bool)
+    percent = text.str.endswith('%').to_numpy(dtype=bool) & ~placeholder
+    plain = ~(placeholder | percent)
+
+    values = np.zeros(len(text))
+    values[percent] = parse_number_column(text[percent].str[:-1], extract=False) / 100
+    values[plain] = parse_number_column(text[plain], extract=True)
+    return values
+
+def column_type_counts(series):
+    """統計原始資料的型別分布（依筆數排序）"""
+    kind = series.dtype.kind
+    if kind == 'f':
+        counts = {'float': len(series)}
+    elif kind in 'iu':
+        counts = {'int': len(series)}
+    elif kind == 'b':
+        counts = {'bool': len(series)}
+    else:
+        counts = Counter(type(value).__name__ for value in series.to_numpy(dtype=object))
+    return dict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
+
+def clean_numeric_column(series):
+    """
+    整欄數值清理，語意與 clean_numeric_value 相同
+    已是數值型態的欄位直接轉換；回傳 (清理後數值, 轉換統計)
+    """
+    stats = {"types": column_type_counts(series)}
+    inferred = pd.api.types.infer_dtype(series, skipna=True)
+
+    if series.dtype.kind in 'iuf' or inferred in ('integer', 'floating', 'mixed-integer-float'):
+        # 數值欄位快速路徑：只需將空值轉為 0
+        values = series.to_numpy(dtype='float64', na_value=np.nan)
+        values = np.where(np.isnan(values), 0.0, values)
+        stats["fast_path"] = True
+    else:
+        if series.dtype.kind not in 'OSU' and not pd.api.types.is_string_dtype(series):
+            series = series.astype(object)
+        # 只對不重複的字串做清理，再以 factorize 代碼對應回每一列
+        codes, uniques = pd.factorize(series.astype(str))
+        unique_values = clean_numeric_text(pd.Series(uniques, dtype=object))
+        values = np.where(codes >= 0, unique_values[codes], 0.0)
+        values[series.isna().to_numpy()] = 0.0
+        stats["fast_path"] = False
+
+    values = pd.Series(values, index=series.index)
+    stats["zero_count"] = int((values == 0).sum())
+    stats["valid_count"] = len(values) - stats["zero_count"]
+    return values, stats
+
+# --- ABC 分析 ---
+# 累計百分比 ≤ A 門檻為 A、≤ B 門檻為 B（預設 70% / 90%，各函式可另外指定 thresholds）
+ABC_THRESHOLDS = (0.7, 0.9)
+ABC_CLASSES = ("A", "B", "C")
+
+def check_thresholds(thresholds):
+    """檢查並回傳 (A 門檻, B 門檻)，需滿足 0 < A ≤ B ≤ 1"""
+    a_threshold, b_threshold = (float(value) for value in thresholds)
+    if not 0 < a_threshold <= b_threshold <= 1:
+        raise ValueError(f"ABC 門檻需滿足 0 < A ≤ B ≤ 1：{a_threshold}, {b_threshold}")
+    return a_threshold, b_threshold
+
+def parse_threshold_pairs(text):
+    """情境比較的門檻組合：「70/90, 80/95」（百分比，組合之間以逗號或換行分隔）→ [(0.7, 0.9), (0.8, 0.95)]"""
+    pairs = []
+    for item in re.split(r"[,\n]", text):
+        if not item.strip():
+            continue
+        values = item.split("/")
+        if len(values) != 2:
+            raise ValueError(f"門檻組合格式為 A/B：{item.strip()}")
+        pairs.append(check_thresholds(float(value) / 100 for value in values))
+    return pairs
+
+def assign_abc_labels(categories, amounts, as_codes=False, thresholds=ABC_THRESHOLDS):
+    """
+    單次計算 ABC 類別：不排序整個資料表，只在各分類內依金額由大到小排序
+    金額為0歸 C；累計百分比 ≤ A 門檻（預設 70%）為 A、≤ B 門檻（預設 90%）為 B、其餘為 C
+    回傳 (累計金額, 累計百分比, ABC類別)，皆依原始列順序；as_codes 為 True 時 ABC類別 以 ABC_CLASSES 的位置（0、1、2）表示
+    """
+    amounts = np.asarray(amounts, dtype='float64')
+    codes, _ = pd.factorize(categories)
+    order = abc_order(codes, amounts)
+
+    cumulative = np.empty(len(amounts))
+    percentage = np.empty(len(amounts))
+    labels = np.empty(len(amounts), dtype=np.int64 if as_codes else '<U1')
+    cumulative[order], percentage[order], labels[order] = abc_shares(codes[order], amounts[order], as_codes, thresholds)
+    return cumulative, percentage, labels
+
+def abc_order(codes, amounts):
+    """列位置的 ABC 順序：先依分類代碼分組（穩定排序），再在各組內依金額由大到小（同額依原始順序）"""
+    order = np.argsort(codes, kind='stable')
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    return np.concatenate([
+        group[np.argsort(-amounts[group], kind='stable')] for group in np.split(order, bounds)
+    ])
+
+def abc_shares(codes, amounts, as_codes=False, thresholds=ABC_THRESHOLDS):
+    """
+    對已依 abc_order 排列的分類代碼與金額做分組累計，回傳 (累計金額, 累計百分比, ABC類別)，皆依傳入順序
+    各分類的結果只與該分類內的順序有關，只傳入部分分類時結果與全部一起計算相同
+    """
+    cumulative, percentage = cumulative_shares(codes, amounts)
+    return cumulative, percentage, abc_classes(percentage, amounts, thresholds, as_codes)
+
+def cumulative_shares(codes, amounts):
+    """對已排列的分類代碼與金額做分組累計，回傳 (累計金額, 累計百分比)"""
+    grouped = pd.Series(amounts).groupby(codes, sort=False)
+    cumulative = grouped.cumsum().to_numpy(copy=True)
+    totals = grouped.transform('sum').to_numpy(copy=True)
+    cumulative[codes < 0] = np.nan
+    totals[codes < 0] = np.nan
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentage = cumulative / totals
+    percentage = np.where(np.isnan(percentage), 0.0, percentage)
+    return cumulative, percentage
+
+def abc_classes(percentage, amounts, thresholds=ABC_THRESHOLDS, as_codes=False):
+    """依累計百分比與門檻指定 ABC 類別（金額為0歸 C）"""
+    a_threshold, b_threshold = check_thresholds(thresholds)
+    return np.select(
+        [amounts == 0, percentage <= a_threshold, percentage <= b_threshold],
+        [2, 0, 1] if as_codes else ['C', 'A', 'B'],
+        default=2 if as_codes else 'C'
+    )
+
+# --- 對外 API ---
+@dataclass(frozen=True)
+class ColumnMapping:
+    """原始資料中四個必要欄位的對應"""
+    prod_col: str
+    currency_col: str
+    qty_col: str
+    price_col: str
+
+@dataclass
+class Diagnostics:
+    """分析過程的提示訊息、數值轉換統計與各階段效能紀錄"""
+    warnings: list = field(default_factory=list)
+    numeric_stats: dict = field(default_factory=dict)
+    timings: list = field(default_factory=list)
+
+    def warn(self, message):
+        self.warnings.append(message)
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        記錄一個處理階段：耗時、每秒筆數、行程記憶體高峰的增加量與輸入／輸出筆數
+        區塊內可設定 record["rows_out"]（未設定時與 rows_in 相同）
+        """
+        record = {"stage": name, "rows_in": rows_in}
+        peak_before = peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            peak_after = peak_rss_mb()
+            record.setdefault("rows_out", rows_in)
+            record["seconds"] = seconds
+            record["rows_per_second"] = rows_in / seconds if rows_in and seconds > 0 else None
+            record["peak_rss_mb"] = peak_after
+            record["peak_rss_delta_mb"] = None if peak_before is None else peak_after - peak_before
+            self.timings.append(record)
+
+@dataclass
+class AnalysisResult:
+    """完整分析結果：分類後的資料表與診斷資訊"""
+    frame: pd.DataFrame
+    diagnostics: Diagnostics
+
+def classify(df, rules, columns, diagnostics=None, memo=None):
+    """依規則新增「分類」欄位（直接修改並回傳傳入的 DataFrame）"""
+    if diagnostics is None:
+        diagnostics = Diagnostics()
+    with diagnostics.stage("主分類", len(df)):
+        df['分類'] = classify_columns(df[columns.prod_col], df[columns.currency_col], rules, diagnostics, memo)
+    return df
+
+def abc(df, columns, diagnostics=None, thresholds=ABC_THRESHOLDS):
+    """
+    在每個主分類內部，獨立進行 ABC 分析（直接修改並回傳傳入的 DataFrame）
+    新增欄位：需求數_清理、單價_清理、金額、累計金額、累計百分比、ABC類別；thresholds 為 (A 門檻, B 門檻)
+    """
+    if diagnostics is None:
+        diagnostics = Diagnostics()
+
+    # 清理需求數和單價（同時取得轉換統計）
+    with diagnostics.stage("數值轉換", len(df)):
+        df['需求數_清理'], qty_stats = clean_numeric_column(df[columns.qty_col])
+        df['單價_清理'], price_stats = clean_numeric_column(df[columns.price_col])
+
+    # 計算金額，並在各分類內依金額計算累計百分比、分配 ABC 類別（不排序整個資料表）
+    with diagnostics.stage("ABC 分析", len(df)):
+        df['金額'] = df['需求數_清理'] * df['單價_清理']
+        df['累計金額'], df['累計百分比'], df['ABC類別'] = assign_abc_labels(df['分類'], df['金額'], thresholds=thresholds)
+
+    record_numeric_stats(diagnostics, qty_stats, price_stats, df['金額'])
+    return df
+
+def record_numeric_stats(diagnostics, qty_stats, price_stats, amounts):
+    """記錄數值轉換統計，金額為0的資料過多時產生警告"""
+    zero_amount_count = int((amounts == 0).sum())
+    diagnostics.numeric_stats = {
+        "需求數": qty_stats,
+        "單價": price_stats,
+        "金額": {
+            "zero_count": zero_amount_count,
+            "valid_count": len(amounts) - zero_amount_count,
+            "total": float(amounts.sum()),
+        },
+    }
+    if zero_amount_count > len(amounts) * 0.1:  # 超過10%的資料金額為0
+        diagnostics.warn(f"⚠️ 注意：有 {zero_amount_count} 筆資料的金額為0，請檢查原始資料品質")
+
+def run_analysis(df, rules, columns, copy=True, memo=None, thresholds=ABC_THRESHOLDS):
+    """執行完整流程（主分類 + ABC 分析），回傳 AnalysisResult"""
+    diagnostics = Diagnostics()
+    frame = df.copy() if copy else df
+    frame = classify(frame, rules, columns, diagnostics, memo)
+    frame = abc(frame, columns, diagnostics, thresholds)
+    return AnalysisResult(frame, diagnostics)
+
+# --- 增量分析：調整規則時只重算受影響的組合與分類 ---
+class IncrementalAnalysis:
+    """
+    同一份資料反覆調整規則時使用：
+        analysis = IncrementalAnalysis(df, columns)
+        frame = analysis.abc(analysis.classify(rules))      # 第一次：完整分類與 ABC 分析
+        frame = analysis.abc(analysis.classify(new_rules))  # 之後：只重算受影響的部分
+
+    保留上次每個 (產品編號, 幣別) 組合的分類順位。分類依優先順序取第一個符合的規則，
+    因此修改第 r 條規則只會影響目前分類順位 ≥ r 的組合（該分類、較後面的分類與「其他」）：
+    這些組合只需以修改過的規則重新比對，原本屬於被修改分類的組合再往後比對其餘規則。
+    數值轉換只做一次；ABC 只對成員有變動的分類重算。
+    分類名稱或順序改變（新增、刪除自訂分類）或規則發生錯誤時，改為完整分類。
+    """
+
+    def __init__(self, df, columns, memo=None):
+        self.source = df
+        self.columns = columns
+        self.memo = memo
+        self.pair_codes, self.unique_prods, self.unique_currencies = factorize_pairs(
+            df[columns.prod_col], df[columns.currency_col]
+        )
+        self.compiled = None
+        self.pair_ranks = None      # 各組合的分類順位，len(分類) 表示「其他」
+        self.row_ranks = None
+        self.changed_ranks = None   # 上次分類中成員有變動的分類順位（None 表示全部）
+        self.numeric = None         # (需求數_清理, 單價_清理, 金額, 需求數統計, 單價統計)
+        self.abc_columns = None     # (累計金額, 累計百分比, ABC類別代碼)
+        self.thresholds = None      # abc_columns 使用的門檻
+
+    def classify(self, rules, diagnostics=None):
+        """回傳加上「分類」欄位的新 DataFrame（與原始資料共用欄位，不修改原始資料）"""
+        if diagnostics is None:
+            diagnostics = Diagnostics()
+        compiled = compile_rules(rules)
+        with diagnostics.stage("主分類", len(self.source)):
+            if self.compiled is not None and [c for c, _ in compiled] == [c for c, _ in self.compiled]:
+                changed = [rank for rank, ((_, old), (_, new)) in enumerate(zip(self.compiled, compiled)) if old != new]
+                pair_ranks = self.reclassify(compiled, changed) if changed else self.pair_ranks
+            else:
+                pair_ranks = None
+
+            # 與 classify_columns 相同的型別（object），增量與完整分類的結果完全相同
+            names = np.array([c for c, _ in compiled] + ["其他"], dtype=object)
+            if pair_ranks is None:
+                unique_labels, failed = classify_pairs(
+                    compiled, self.unique_prods, self.unique_currencies, diagnostics, self.memo
+                )
+                if failed:
+                    # 「錯誤」不對應任何順位，下次一律完整分類
+                    self.compiled = self.pair_ranks = self.row_ranks = self.changed_ranks = None
+                    frame = self.source.copy(deep=False)
+                    frame['分類'] = pd.Series(unique_labels[self.pair_codes], index=frame.index, dtype=object)
+                    return frame
+                rank_of = {name: rank for rank, (name, _) in enumerate(compiled)}
+                rank_of["其他"] = len(compiled)
+                pair_ranks = pd.Series(unique_labels).map(rank_of).to_numpy(dtype=np.int64)
+                self.changed_ranks = None
+            else:
+                self.changed_ranks = np.union1d(
+                    self.pair_ranks[pair_ranks != self.pair_ranks], pair_ranks[pair_ranks != self.pair_ranks]
+                )
+
+            self.compiled, self.pair_ranks = compiled, pair_ranks
+            self.row_ranks = pair_ranks[self.pair_codes]
+            frame = self.source.copy(deep=False)
+            frame['分類'] = pd.Series(names.take(self.row_ranks), index=frame.index, dtype=object)
+        return frame
+
+    def reclassify(self, compiled, changed):
+        """只重新比對受影響的組合；規則比對發生錯誤時回傳 None（改為完整分類以產生警告）"""
+        old_ranks = self.pair_ranks
+        new_ranks = old_ranks.copy()
+        is_changed = np.zeros(len(compiled) + 1, dtype=bool)
+        is_changed[changed] = True
+
+        def matches(rank, pairs):
+            return compiled.entries[rank][1].mask(
+                pd.Series(self.unique_prods[pairs]), pd.Series(self.unique_currencies[pairs])
+            ).to_numpy(dtype=bool)
+
+        try:
+            # 修改後的規則可能搶走順位在它之後的組合
+            stolen = np.zeros(len(old_ranks), dtype=bool)
+            for rank in changed:
+                pairs = np.flatnonzero((old_ranks >= rank) & ~stolen)
+                hit = pairs[matches(rank, pairs)]
+                new_ranks[hit] = rank
+                stolen[hit] = True
+
+            # 原本屬於被修改分類、現在不再符合的組合，依序比對後面的規則
+            remaining = np.flatnonzero(is_changed[old_ranks] & ~stolen)
+            new_ranks[remaining] = len(compiled)
+            for rank in range(len(compiled)):
+                if len(remaining) == 0:
+                    break
+                pairs = remaining[old_ranks[remaining] < rank]
+                if len(pairs) == 0:
+                    continue
+                hit = pairs[matches(rank, pairs)]
+                new_ranks[hit] = rank
+                remaining = np.setdiff1d(remaining, hit, assume_unique=True)
+        except Exception:
+            return None
+        return new_ranks
+
+    def abc(self, frame, diagnostics=None, thresholds=ABC_THRESHOLDS):
+        """在 classify 回傳的 DataFrame 加上數值與 ABC 欄位（欄位與 abc() 相同）；門檻改變時所有分類重算"""
+        if diagnostics is None:
+            diagnostics = Diagnostics()
+        if self.numeric is None:
+            with diagnostics.stage("數值轉換", len(frame)):
+                qty, qty_stats = clean_numeric_column(self.source[self.columns.qty_col])
+                price, price_stats = clean_numeric_column(self.source[self.columns.price_col])
+                self.numeric = (qty, price, qty * price, qty_stats, price_stats)
+        qty, price, amounts, qty_stats, price_stats = self.numeric
+        frame['需求數_清理'], frame['單價_清理'], frame['金額'] = qty, price, amounts
+
+        with diagnostics.stage("ABC 分析", len(frame)):
+            if self.row_ranks is None:
+                # 分類發生錯誤：以分類名稱完整計算
+                self.abc_columns = None
+                cumulative, percentage, labels = assign_abc_labels(frame['分類'], amounts, thresholds=thresholds)
+            elif self.abc_columns is None or self.changed_ranks is None or self.thresholds != tuple(thresholds):
+                cumulative, percentage, labels = assign_abc_labels(self.row_ranks, amounts, True, thresholds)
+            else:
+                cumulative, percentage, labels = (column.copy() for column in self.abc_columns)
+                rows = np.flatnonzero(np.isin(self.row_ranks, self.changed_ranks))
+                if len(rows):
+                    cumulative[rows], percentage[rows], labels[rows] = assign_abc_labels(
+                        self.row_ranks[rows], amounts.to_numpy()[rows], True, thresholds
+                    )
+            if self.row_ranks is not None:
+                self.abc_columns, self.thresholds = (cumulative, percentage, labels), tuple(thresholds)
+                labels = np.array(ABC_CLASSES)[labels]  # 與 assign_abc_labels 相同的型別
+            frame['累計金額'], frame['累計百分比'], frame['ABC類別'] = cumulative, percentage, labels
+
+        record_numeric_stats(diagnostics, qty_stats, price_stats, amounts)
+        return frame
+
+    def release(self):
+        """釋放數值與 ABC 欄位（結果已精簡、不再共用這些欄位時），下次 abc() 時重新計算；分類順位保留"""
+        self.numeric = self.abc_columns = self.thresholds = None
+
+    def arrays(self):
+        """保留的陣列（不含原始資料），用於計算工作階段占用的記憶體"""
+        kept = [self.pair_codes, self.unique_prods, self.unique_currencies, self.pair_ranks, self.row_ranks, self.changed_ranks]
+        kept += self.numeric[:3] if self.numeric is not None else []
+        kept += self.abc_columns if self.abc_columns is not None else []
+        return [values for values in kept if values is not None]
+
+# --- ABC 分類帳：在既有結果上追加或更新資料 ---
+class AbcLedger:
+    """
+    可持續追加資料的 ABC 分類帳（例如每月的基礎資料加上每週的異動檔）：
+        ledger = AbcLedger(run_analysis(base, rules, columns).frame)
+        changes = ledger.update(run_analysis(delta, rules, columns).frame)
+        ledger.frame      # 與「基礎資料套用異動後」完整重算的結果相同
+        changes           # ABC 類別有變動的資料
+
+    以 DataFrame 的索引識別每一筆資料：異動檔中索引已存在的列視為更新（保留原位置），其餘追加在最後。
+    每個分類保留依金額由大到小（同額依列順序）排列的列位置；更新時以二分搜尋插入新資料、移除被更新的舊資料，
+    不重新排序，也只重算有異動的分類的累計金額、累計百分比與 ABC 類別。
+    thresholds 需與產生 frame 時的 ABC 門檻相同。
+    """
+
+    def __init__(self, frame, thresholds=ABC_THRESHOLDS):
+        if not frame.index.is_unique:
+            raise ValueError("資料的索引必須唯一（用來對應異動資料）")
+        self.frame = frame
+        self.thresholds = check_thresholds(thresholds)
+        self.category_codes = {}
+        self.codes = self.encode_categories(frame['分類'])
+        self.labels = frame['ABC類別'].map({label: code for code, label in enumerate(ABC_CLASSES)}).to_numpy(dtype=np.int8)
+        amounts = frame['金額'].to_numpy(dtype='float64')
+        order = abc_order(self.codes, amounts)
+        bounds = np.flatnonzero(np.diff(self.codes[order])) + 1
+        self.orders = {int(self.codes[group[0]]): group for group in np.split(order, bounds) if len(group)}
+
+    def encode_categories(self, categories):
+        """分類名稱 → 代碼（新的分類給新的代碼）"""
+        for name in pd.unique(categories):
+            self.category_codes.setdefault(name, len(self.category_codes))
+        return categories.map(self.category_codes).to_numpy(dtype=np.int64)
+
+    def update(self, rows):
+        """
+        套用異動資料（run_analysis 的結果，需包含分類帳的所有欄位），回傳 ABC 類別有變動的資料：
+        原分類、分類、原ABC類別（新增的資料為空值）、ABC類別，依列順序排列
+        """
+        if not rows.index.is_unique:
+            raise ValueError("異動資料的索引不可重複")
+        missing = [column for column in self.frame.columns if column not in rows.columns]
+        if missing:
+            raise ValueError(f"異動資料缺少欄位：{', '.join(map(str, missing))}")
+        rows = rows[list(self.frame.columns)]
+
+        old_size = len(self.frame)
+        existing = self.frame.index.get_indexer(rows.index)
+        is_update = existing >= 0
+        updated = existing[is_update]
+        appended = old_size + np.arange(int((~is_update).sum()))
+
+        # 更新的列留在原位置，新增的列接在最後；合併後的欄位型別與直接合併原始資料相同
+        take = np.arange(old_size)
+        take[updated] = old_size + np.flatnonzero(is_update)
+        take = np.concatenate([take, old_size + np.flatnonzero(~is_update)])
+        old_frame = self.frame
+        frame = pd.concat([old_frame, rows]).iloc[take]
+
+        new_codes = self.encode_categories(rows['分類'])
+        codes = np.concatenate([self.codes, new_codes[~is_update]])
+        codes[updated] = new_codes[is_update]
+        amounts = frame['金額'].to_numpy(dtype='float64')
+
+        # 只調整受影響的分類：移除被更新的舊位置，依 (金額由大到小, 列位置) 插入新位置
+        changed_positions = np.concatenate([updated, appended])
+        touched = np.union1d(self.codes[updated], codes[changed_positions])
+        for code in touched.tolist():
+            positions = self.orders.get(code, np.empty(0, dtype=np.int64))
+            positions = positions[~np.isin(positions, updated)]
+            inserts = changed_positions[codes[changed_positions] == code]
+            inserts = inserts[np.lexsort((inserts, -amounts[inserts]))]
+            keys = -amounts[positions]
+            index = np.searchsorted(keys, -amounts[inserts], side='right')
+            low = np.searchsorted(keys, -amounts[inserts], side='left')
+            # 同額的資料依列位置排列（只有更新的列可能排在既有同額資料之前）
+            for i in np.flatnonzero((index > low) & (inserts < old_size)):
+                index[i] = low[i] + np.searchsorted(positions[low[i]:index[i]], inserts[i])
+            positions = np.insert(positions, index, inserts)
+            if len(positions):
+                self.orders[code] = positions
+            else:
+                self.orders.pop(code, None)
+
+        order = np.concatenate([self.orders[code] for code in touched.tolist() if code in self.orders] or [np.empty(0, dtype=np.int64)])
+        cumulative = frame['累計金額'].to_numpy(dtype='float64', copy=True)
+        percentage = frame['累計百分比'].to_numpy(dtype='float64', copy=True)
+        labels = np.concatenate([self.labels, np.full(len(appended), -1, dtype=np.int8)])
+        labels[updated] = -1
+        cumulative[order], percentage[order], labels[order] = abc_shares(
+            codes[order], amounts[order], True, self.thresholds
+        )
+        classes = pd.array(ABC_CLASSES, dtype="str")
+        frame['累計金額'], frame['累計百分比'], frame['ABC類別'] = cumulative, percentage, np.array(ABC_CLASSES)[labels]
+
+        # 異動前後的 ABC 類別（被更新的列以更新前的資料比較，新增的列為空值）
+        order.sort()
+        previous = np.concatenate([self.labels, np.full(len(appended), -1, dtype=np.int8)])[order]
+        is_changed = previous != labels[order]
+        changed = order[is_changed]
+        changes = pd.DataFrame({
+            "原分類": old_frame['分類'].array.take(np.where(changed < old_size, changed, -1), allow_fill=True),
+            "分類": frame['分類'].array.take(changed),
+            "原ABC類別": classes.take(previous[is_changed], allow_fill=True),
+            "ABC類別": classes.take(labels[changed]),
+        }, index=frame.index[changed])
+
+        self.frame, self.codes, self.labels = frame, codes, labels
+        return changes
+
+    def save(self, path):
+        """先寫入暫存檔再改名，寫到一半中斷時不會破壞原本的分類帳"""
+        path = Path(path)
+        staging = path.with_name(path.name + ".tmp")
+        with open(staging, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(staging, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+def result_summary(frame):
+    """
+    單次 groupby 彙總每個 (分類, ABC類別) 的筆數、總金額與金額為0的筆數（依首次出現順序）
+    各統計表、圖表與交叉分析都由這個小表推導，不需再掃描整個資料表
+    """
+    amounts = frame['金額']
+    grouped = pd.DataFrame({'金額': amounts, '金額為0': amounts == 0}).groupby(
+        [frame['分類'].astype(object), frame['ABC類別'].astype(object)], sort=False
+    )
+    return grouped.agg(筆數=('金額', 'size'), 總金額=('金額', 'sum'), 金額為0筆數=('金額為0', 'sum')).reset_index()
+
+def summary_tables(frame, summary=None):
+    """
+    分類結果與各統計表：主分類、ABC 類別、各分類金額、交叉分析（畫面顯示、下載與快取共用）
+    統計表皆由 result_summary 推導；彙總表本身以「分類ABC彙總」一併保存
+    """
+    summary = result_summary(frame) if summary is None else summary
+    counts = summary.groupby('分類', sort=False)['筆數'].sum()
+    cross = summary.pivot(index='分類', columns='ABC類別', values='筆數').fillna(0).astype('int64')
+    cross['All'] = cross.sum(axis=1)
+    cross.loc['All'] = cross.sum()
+    return {
+        "分類結果": frame,
+        "主分類統計": counts.sort_values(ascending=False, kind='stable').rename("數量").to_frame(),
+        "ABC分類統計": summary.groupby('ABC類別', sort=False)['筆數'].sum().sort_values(ascending=False, kind='stable').rename("數量").to_frame(),
+        "金額統計": summary.groupby('分類')['總金額'].sum().sort_values(ascending=False).to_frame(),
+        "交叉分析": cross,
+        "分類ABC彙總": summary,
+    }
+
+# --- ABC 門檻情境比較 ---
+# 排序與累計的基準：(排序依據, 累計的數值)；筆數基準依金額排序、每筆計為 1（例如前 70% 的品項為 A）
+SCENARIO_BASES = {
+    "金額": ("金額", "金額"),
+    "需求數": ("需求數", "需求數"),
+    "筆數": ("金額", "筆數"),
+}
+
+def abc_scenarios(frame, scenarios, bases=("金額",), columns=None):
+    """
+    多組門檻與排序基準的 ABC 比較：每個基準只在各分類內排序與累計一次，各組門檻只需重新比較累計百分比
+    scenarios 為 [(A 門檻, B 門檻), ...]；bases 為 SCENARIO_BASES 的名稱
+    需求數基準使用 需求數_清理（精簡後的結果沒有此欄位時，需傳入 columns 以重新清理需求數）
+    回傳長表：情境、基準、A門檻、B門檻、分類、ABC類別、筆數、金額、金額占比（該分類總金額中的占比），
+    以金額為基準、門檻與分析時相同的情境，ABC類別 與分析結果相同
+    """
+    scenarios = list(dict.fromkeys(check_thresholds(thresholds) for thresholds in scenarios))
+    bases = list(dict.fromkeys(bases))
+    codes, names = pd.factorize(frame['分類'].astype(object))
+    values = {"金額": frame['金額'].to_numpy(dtype='float64'), "筆數": np.ones(len(frame))}
+    if "需求數" in bases:
+        qty = frame['需求數_清理'] if '需求數_清理' in frame.columns else clean_numeric_column(frame[columns.qty_col])[0]
+        values["需求數"] = qty.to_numpy(dtype='float64')
+    category_totals = np.bincount(codes, weights=values["金額"], minlength=len(names))
+
+    parts = []
+    for basis in bases:
+        sort_key, weight = SCENARIO_BASES[basis]
+        order = abc_order(codes, values[sort_key])
+        sorted_codes, sorted_weights = codes[order], values[weight][order]
+        sorted_amounts = values["金額"][order]
+        _, percentage = cumulative_shares(sorted_codes, sorted_weights)
+        for a_threshold, b_threshold in scenarios:
+            labels = abc_classes(percentage, sorted_weights, (a_threshold, b_threshold), as_codes=True)
+            cells = sorted_codes * len(ABC_CLASSES) + labels
+            size = len(names) * len(ABC_CLASSES)
+            amounts = np.bincount(cells, weights=sorted_amounts, minlength=size)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                shares = np.nan_to_num(amounts / np.repeat(category_totals, len(ABC_CLASSES)))
+            parts.append(pd.DataFrame({
+                "情境": f"{basis} {a_threshold * 100:g}%/{b_threshold * 100:g}%",
+                "基準": basis,
+                "A門檻": a_threshold,
+                "B門檻": b_threshold,
+                "分類": np.repeat(np.asarray(names, dtype=object), len(ABC_CLASSES)),
+                "ABC類別": np.tile(ABC_CLASSES, len(names)),
+                "筆數": np.bincount(cells, minlength=size),
+                "金額": amounts,
+                "金額占比": shares,
+            }))
+    columns_out = ["情境", "基準", "A門檻", "B門檻", "分類", "ABC類別", "筆數", "金額", "金額占比"]
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=columns_out)
+
+def scenario_matrix(table, value="筆數"):
+    """情境 × (分類, ABC類別) 的矩陣，列與欄依 abc_scenarios 的順序"""
+    matrix = table.pivot(index="情境", columns=["分類", "ABC類別"], values=value)
+    return matrix.reindex(index=pd.unique(table["情境"]), columns=pd.MultiIndex.from_frame(table[["分類", "ABC類別"]].drop_duplicates()))
+
+# --- 結果檢視：伺服器端篩選、排序與分頁 ---
+class ResultView:
+    """
+    分類結果的伺服器端檢視，畫面只需取出目前這一頁：
+        view = ResultView(frame, ["分類", "ABC類別", "幣別"])
+        positions = view.positions({"分類": ["進口"]}, sort_by="金額")
+        view.page(positions, page=0, page_size=100)
+    篩選欄位只在建立時編碼一次；篩選與排序的結果保留到條件改變為止，翻頁不需重新計算
+    """
+
+    def __init__(self, frame, filter_columns):
+        self.frame = frame
+        self.choices = {column: factorize_text_column(frame[column]) for column in filter_columns}
+        self._positions_key = None
+        self._positions = None
+
+    def options(self, column):
+        """篩選欄位的選項（去空白後的相異值，空值為空字串）"""
+        return list(self.choices[column][1])
+
+    def positions(self, filters=None, sort_by=None, ascending=False):
+        """符合篩選條件（{欄位: 選取的值}，空的條件不篩選）的列位置，依 sort_by 排序（空值在最後）"""
+        filters = tuple((column, tuple(selected)) for column, selected in (filters or {}).items() if selected)
+        key = (filters, sort_by, ascending)
+        if key == self._positions_key:
+            return self._positions
+
+        mask = np.ones(len(self.frame), dtype=bool)
+        for column, selected in filters:
+            codes, uniques = self.choices[column]
+            wanted = np.flatnonzero(np.isin(np.asarray(uniques, dtype=object), list(selected)))
+            mask &= np.isin(codes, wanted)
+        positions = np.flatnonzero(mask)
+        if sort_by is not None:
+            values = self.frame[sort_by].to_numpy(dtype=float)[positions]
+            positions = positions[np.argsort(values if ascending else -values, kind="stable")]
+
+        self._positions_key, self._positions = key, positions
+        return positions
+
+    def page(self, positions, page, page_size, columns=None):
+        """取出第 page 頁（從 0 起算）；columns 為要顯示的欄位位置（None 表示全部欄位）"""
+        rows = positions[page * page_size:(page + 1) * page_size]
+        if columns is None:
+            return self.frame.iloc[rows]
+        return self.frame.iloc[rows, list(columns)]
+
+# --- 結果精簡：降低每個工作階段保留的記憶體 ---
+# 可由其他欄位推導、精簡時移除的中間欄位（匯出前以 expand_result 補回）
+DERIVED_COLUMNS = ['需求數_清理', '單價_清理', '累計金額']
+RESULT_COLUMNS = ['分類', '需求數_清理', '單價_清理', '金額', '累計金額', '累計百分比', 'ABC類別']
+
+def is_compact(frame):
+    return '分類' in frame.columns and '累計金額' not in frame.columns
+
+def compact_result(frame, columns, shared=None):
+    """
+    回傳記憶體精簡後的結果（不修改傳入的 DataFrame）：
+    分類、ABC類別、幣別改為類別型別，移除 DERIVED_COLUMNS，原始欄位中全為文字的 object 欄位改為字串型別、
+    整數欄位縮小為足以容納的型別；金額與累計百分比維持 float64，統計加總結果不變
+    shared 為多個工作階段共用的原始資料：與它共用記憶體的原始欄位維持原樣（轉換只會多複製一份）
+    """
+    if is_compact(frame):
+        return frame
+    shared_blocks = set() if shared is None else data_blocks(shared)
+    result = frame.drop(columns=DERIVED_COLUMNS)
+    for position in range(result.shape[1]):
+        name = result.columns[position]
+        values = result.iloc[:, position]
+        if name not in RESULT_COLUMNS and not shared_blocks.isdisjoint(array_blocks(values, items=False)):
+            continue
+        if name in ('分類', 'ABC類別', columns.currency_col):
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                # 只保留實際出現的值，value_counts、crosstab 不會多出筆數為0的類別
+                result.isetitem(position, values.astype("category"))
+            continue
+        if name in RESULT_COLUMNS:
+            continue
+        if pd.api.types.is_integer_dtype(values.dtype) and not isinstance(values.dtype, pd.CategoricalDtype):
+            result.isetitem(position, pd.to_numeric(values, downcast="integer"))
+        elif values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) == "string":
+            result.isetitem(position, values.astype("str"))
+    return result
+
+def expand_result(frame, columns):
+    """補回 compact_result 移除的欄位、類別欄位還原為字串，欄位順序與數值與精簡前相同（原始欄位維持精簡後的型別）"""
+    if not is_compact(frame):
+        return frame
+    result = frame.copy(deep=False)
+    for column in ('分類', 'ABC類別', columns.currency_col):
+        if isinstance(result[column].dtype, pd.CategoricalDtype):
+            result[column] = result[column].astype(result[column].cat.categories.dtype)
+    position = result.columns.get_loc('分類') + 1
+    result.insert(position, '需求數_清理', clean_numeric_column(result[columns.qty_col])[0])
+    result.insert(position + 1, '單價_清理', clean_numeric_column(result[columns.price_col])[0])
+    codes, _ = pd.factorize(result['分類'])
+    amounts = result['金額'].to_numpy(dtype='float64')
+    order = abc_order(codes, amounts)
+    cumulative = np.empty(len(amounts))
+    cumulative[order] = abc_shares(codes[order], amounts[order])[0]
+    result.insert(position + 3, '累計金額', cumulative)
+    return result
+
+def memory_mb(frame):
+    """DataFrame 實際占用的記憶體（MB，含字串內容）"""
+    return frame.memory_usage(deep=True).sum() / 1024 / 1024
+
+def array_blocks(values, items=True):
+    """
+    陣列使用的記憶體區塊 {位址: 位元組數}，items 為 True 時另計 object 陣列的各元素本身；
+    淺複製、寫入時複製而共用資料的欄位得到相同的區塊
+    """
+    if isinstance(values, (pd.Series, pd.Index)):
+        if isinstance(values, pd.RangeIndex):
+            return {}
+        values = values.array
+    if isinstance(values, pd.Categorical):
+        return {**array_blocks(values.codes), **array_blocks(values.categories, items)}
+    if hasattr(values, "__arrow_array__"):
+        return {
+            buffer.address: buffer.size
+            for chunk in values.__arrow_array__().chunks
+            for buffer in chunk.buffers()
+            if buffer is not None
+        }
+    if hasattr(values, "asi8"):
+        values = values.asi8
+    elif not isinstance(values, (np.ndarray, pd.arrays.NumpyExtensionArray)):
+        return {id(values): values.nbytes}
+    array = np.asarray(values)
+    base = array
+    while isinstance(base.base, np.ndarray):
+        base = base.base
+    blocks = {base.__array_interface__['data'][0]: base.nbytes}
+    if items and array.dtype == object:
+        blocks.update((id(item), sys.getsizeof(item)) for item in array)
+    return blocks
+
+def frame_arrays(objects):
+    """依序產生 objects 中的陣列：DataFrame 展開為索引與各欄位，Series 與陣列原樣產生"""
+    for obj in objects:
+        if isinstance(obj, pd.DataFrame):
+            yield obj.index
+            for position in range(obj.shape[1]):
+                yield obj.iloc[:, position]
+        else:
+            yield obj
+
+def data_blocks(frame):
+    """DataFrame 各欄位與索引的資料區塊位址（不含 object 陣列的各元素）"""
+    return {address for values in frame_arrays([frame]) for address in array_blocks(values, items=False)}
+
+def footprint_mb(objects, shared=None):
+    """
+    objects（DataFrame、Series 或陣列）實際占用的記憶體（MB）：共用的區塊只計一次，
+    資料與 shared（多個工作階段共用的原始資料）共用的陣列不計入
+    """
+    excluded = set() if shared is None else data_blocks(shared)
+    blocks = {}
+    for values in frame_arrays(objects):
+        if excluded and excluded.issuperset(array_blocks(values, items=False)):
+            continue
+        blocks.update(array_blocks(values))
+    return sum(blocks.values()) / 1024 / 1024
+
+# --- 分塊處理：檔案大於記憶體時使用 ---
+RESULT_CATEGORIES = ["進口", *DOMESTIC_CATEGORIES, "其他", "錯誤"]
+
+def merge_numeric_stats(total, stats):
+    """合併各塊的數值轉換統計"""
+    if not total:
+        return {**stats, "types": dict(stats["types"])}
+    types = Counter(total["types"])
+    types.update(stats["types"])
+    return {
+        "types": dict(sorted(types.items(), key=lambda item: item[1], reverse=True)),
+        "fast_path": total["fast_path"] and stats["fast_path"],
+        "zero_count": total["zero_count"] + stats["zero_count"],
+        "valid_count": total["valid_count"] + stats["valid_count"],
+    }
+
+def run_analysis_chunked(chunks, rules, columns, write_chunk, spill_dir=None, memo=None, thresholds=ABC_THRESHOLDS):
+    """
+    分塊執行完整流程，記憶體用量只與單一區塊大小（及每列數個位元組的索引）有關
+
+    第一輪：逐塊分類、清理數值並計算金額，結果暫存到 spill_dir，只在記憶體中保留每列的分類代碼與金額
+    之後：以每列的分類代碼與金額一次計算各分類的排序、累計金額與 ABC 類別（與 run_analysis 相同）
+    第二輪：依序讀回暫存區塊，補上 ABC 欄位後交給 write_chunk 輸出
+    回傳 Diagnostics；輸出的列順序與結果皆與 run_analysis 相同
+    """
+    diagnostics = Diagnostics()
+    compiled = compile_rules(rules)
+    # 各區塊常有相同料號，未指定時也在區塊之間共用備忘表
+    memo = ClassificationMemo() if memo is None else memo
+    category_names = RESULT_CATEGORIES + [name for name, _ in compiled if name not in RESULT_CATEGORIES]
+    category_codes = {name: code for code, name in enumerate(category_names)}
+    code_parts, amount_parts, qty_stats, price_stats = [], [], {}, {}
+
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp:
+        spill_files = []
+        for index, chunk in enumerate(chunks):
+            chunk_diagnostics = Diagnostics()
+            chunk = classify(chunk, compiled, columns, chunk_diagnostics, memo)
+            chunk['需求數_清理'], stats = clean_numeric_column(chunk[columns.qty_col])
+            qty_stats = merge_numeric_stats(qty_stats, stats)
+            chunk['單價_清理'], stats = clean_numeric_column(chunk[columns.price_col])
+            price_stats = merge_numeric_stats(price_stats, stats)
+            chunk['金額'] = chunk['需求數_清理'] * chunk['單價_清理']
+            for message in chunk_diagnostics.warnings:
+                if message not in diagnostics.warnings:
+                    diagnostics.warn(message)
+
+            code_parts.append(chunk['分類'].map(category_codes).to_numpy(dtype='int16'))
+            amount_parts.append(chunk['金額'].to_numpy(dtype='float64'))
+            path = f"{tmp}/chunk_{index:06d}.pkl"
+            with open(path, "wb") as f:
+                pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+            spill_files.append(path)
+            del chunk
+
+        codes = np.concatenate(code_parts) if code_parts else np.empty(0, dtype='int16')
+        amounts = np.concatenate(amount_parts) if amount_parts else np.empty(0)
+        del code_parts, amount_parts
+        cumulative, percentage, labels = assign_abc_labels(codes, amounts, thresholds=thresholds)
+
+        record_numeric_stats(diagnostics, qty_stats, price_stats, pd.Series(amounts))
+
+        offset = 0
+        for path in spill_files:
+            with open(path, "rb") as f:
+                chunk = pickle.load(f)
+            end = offset + len(chunk)
+            chunk['累計金額'] = cumulative[offset:end]
+            chunk['累計百分比'] = percentage[offset:end]
+            chunk['ABC類別'] = labels[offset:end]
+            write_chunk(chunk)
+            offset = end
+
+    return diagnostics
@@ -0,0 +1,290 @@
+"""
+檔案讀取：將上傳或本機的 Excel / CSV 轉為 DataFrame
+
+上傳的檔案以內容雜湊識別，工作表名稱只從活頁簿中繼資料取得，不會為了列出工作表而解析整本活頁簿。
+"""
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+from xml.etree import ElementTree
+
+import numpy as np
+import pandas as pd
+from pandas.io.parsers import TextParser
+
+try:
+    import pyarrow  # noqa: F401  選用：Parquet 匯出
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+try:
+    import python_calamine  # noqa: F401  選用：以 Rust 實作的快速 Excel 讀取引擎
+    HAS_CALAMINE = True
+except ImportError:
+    HAS_CALAMINE = False
+
+def content_hash(file_bytes):
+    """檔案內容的 SHA-256 雜湊，作為快取鍵"""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+def open_source(source):
+    """檔案路徑直接使用，位元組內容包成 BytesIO"""
+    return io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+
+def is_csv(source):
+    return not isinstance(source, (bytes, bytearray)) and str(source).lower().endswith(".csv")
+
+def list_sheet_names(source):
+    """只讀取 xl/workbook.xml 取得工作表名稱（依活頁簿順序），不解析任何工作表內容"""
+    try:
+        with zipfile.ZipFile(open_source(source)) as archive:
+            root = ElementTree.fromstring(archive.read("xl/workbook.xml"))
+    except (zipfile.BadZipFile, KeyError):
+        # 不是 xlsx 格式時退回 pandas 的讀取方式
+        with pd.ExcelFile(open_source(source)) as xls:
+            return xls.sheet_names
+
+    # 不依賴特定命名空間（同時支援一般與 Strict OOXML）
+    for element in root:
+        if element.tag.rsplit("}", 1)[-1] == "sheets":
+            return [sheet.get("name") for sheet in element if sheet.tag.rsplit("}", 1)[-1] == "sheet"]
+    return []
+
+def read_sheet(source, sheet_name):
+    """解析單一工作表（完整讀取）"""
+    if is_csv(source):
+        return pd.read_csv(source)
+    return pd.read_excel(open_source(source), sheet_name=sheet_name)
+
+# --- 快速讀取：只讀取需要的欄位 ---
+def read_header(source, sheet_name=0):
+    """只讀取標題列，取得與 read_excel 相同的欄位名稱（含重複欄名的 .1 編號）"""
+    if is_csv(source):
+        return pd.read_csv(source, nrows=0).columns.tolist()
+    return pd.read_excel(open_source(source), sheet_name=sheet_name, nrows=0).columns.tolist()
+
+def convert_openpyxl_cell(cell):
+    """與 pandas openpyxl 讀取器相同的儲存格轉換（空白為 ""、錯誤值為 NaN、整數值浮點轉為 int）"""
+    value = cell.value
+    if value is None:
+        return ""
+    elif cell.data_type == "e":
+        return np.nan
+    elif cell.data_type == "n":
+        as_int = int(value)
+        return as_int if as_int == value else float(value)
+    return value
+
+def iter_excel_rows(source, sheet_name, positions):
+    """
+    以 openpyxl 唯讀串流模式逐列產生資料列（只保留 positions 指定的欄位，不含標題列）
+    與 pandas 相同會略過工作表尾端的空白列
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(open_source(source), read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = workbook[sheet_name] if isinstance(sheet_name, str) else workbook.worksheets[sheet_name]
+        sheet.reset_dimensions()
+        pending_empty_rows = []
+        for row in sheet.iter_rows(min_row=2):
+            converted = [convert_openpyxl_cell(row[pos]) if pos < len(row) else "" for pos in positions]
+            if not any(cell.value is not None for cell in row):
+                # 空白列先暫存，後面還有資料時才輸出
+                pending_empty_rows.append(converted)
+                continue
+            yield from pending_empty_rows
+            pending_empty_rows = []
+            yield converted
+    finally:
+        workbook.close()
+
+def parse_rows(rows, names, dtype=None):
+    """交給 pandas TextParser 做與 read_excel 相同的型別推斷與空值判斷"""
+    if not rows:
+        return pd.DataFrame(columns=names).astype({name: object for name in names})
+    return TextParser(rows, names=list(names), header=None, dtype=dtype, skip_blank_lines=False).read()
+
+def as_text_column(series):
+    """
+    將完整讀取（已推斷型別）的欄位轉為與 read_excel(dtype=str) 相同的字串
+    整數值的數字不帶小數點（與 convert_openpyxl_cell 一致），空值維持 NaN
+    """
+    if isinstance(series.dtype, pd.StringDtype):
+        return series
+    codes, uniques = pd.factorize(series)
+    texts = np.array(
+        [str(int(value)) if isinstance(value, float) and value.is_integer() else str(value) for value in uniques] + [np.nan],
+        dtype=object,
+    )
+    return pd.Series(texts[codes], index=series.index, name=series.name, dtype="str")
+
+def stream_excel_columns(source, sheet_name, usecols, dtype=None):
+    """
+    以 openpyxl 唯讀串流模式讀取指定欄位
+    結果與 pd.read_excel(usecols=..., dtype=...) 相同，但不需在記憶體中保留整張工作表
+    """
+    header = read_header(source, sheet_name)
+    positions = [header.index(name) for name in usecols]
+    return parse_rows(list(iter_excel_rows(source, sheet_name, positions)), usecols, dtype)
+
+def read_columns(source, sheet_name=0, usecols=None, text_cols=(), engine="auto"):
+    """
+    快速讀取模式：只讀取 usecols 指定的欄位，text_cols（產品編號、幣別）一律讀為字串
+    engine：auto（有安裝 python-calamine 時使用，否則 openpyxl 串流）、calamine、openpyxl
+    """
+    dtype = {name: str for name in text_cols}
+    if is_csv(source):
+        return pd.read_csv(source, usecols=usecols, dtype=dtype)
+    if engine == "calamine" or (engine == "auto" and HAS_CALAMINE):
+        return pd.read_excel(open_source(source), sheet_name=sheet_name, usecols=usecols, dtype=dtype, engine="calamine")
+    return stream_excel_columns(source, sheet_name, usecols, dtype)
+
+# --- 分塊讀取：檔案大於記憶體時使用 ---
+def iter_chunks(source, sheet_name=0, chunksize=100_000, usecols=None, text_cols=()):
+    """
+    逐塊產生 DataFrame（每塊最多 chunksize 列），usecols 為 None 時讀取標題列上的所有欄位
+    text_cols 一律讀為字串，確保各塊的產品編號與幣別型別一致
+    """
+    dtype = {name: str for name in text_cols}
+    if is_csv(source):
+        yield from pd.read_csv(source, usecols=usecols, dtype=dtype, chunksize=chunksize)
+        return
+
+    header = read_header(source, sheet_name)
+    names = header if usecols is None else [name for name in header if name in usecols]
+    positions = [header.index(name) for name in names]
+    rows = []
+    for row in iter_excel_rows(source, sheet_name, positions):
+        rows.append(row)
+        if len(rows) >= chunksize:
+            yield parse_rows(rows, names, dtype)
+            rows = []
+    if rows:
+        yield parse_rows(rows, names, dtype)
+
+# --- 串流寫出 xlsx ---
+class XlsxStreamWriter:
+    """
+    以 xlsxwriter 的 constant_memory 模式逐列寫出 xlsx，記憶體用量與資料列數無關
+    每個工作表的資料必須依序附加（write_frame 可對同一工作表重複呼叫）
+    target 為 BytesIO 等檔案物件時先寫到暫存檔（xlsxwriter 的 in_memory 模式會停用 constant_memory），關閉時再複製過去
+    """
+    HEADER_FORMAT = {"bold": True, "border": 1, "align": "center", "valign": "top"}  # 與 pandas 預設標題樣式相同
+    BLOCK_ROWS = 10_000  # 每次轉為 object 的列數
+
+    def __init__(self, target):
+        import xlsxwriter
+
+        self.target = self.temp_path = None
+        if not isinstance(target, (str, bytes)) and not hasattr(target, "__fspath__"):
+            handle, self.temp_path = tempfile.mkstemp(suffix=".xlsx")
+            os.close(handle)
+            self.target, target = target, self.temp_path
+        self.workbook = xlsxwriter.Workbook(target, {
+            "constant_memory": True,
+            "nan_inf_to_errors": True,
+            "default_date_format": "yyyy-mm-dd hh:mm:ss",
+        })
+        self.header_format = self.workbook.add_format(self.HEADER_FORMAT)
+        self.sheets = {}
+        self.next_rows = {}
+
+    def write_frame(self, sheet_name, frame, index=False):
+        """將 frame 附加到工作表；第一次寫入時先寫標題列"""
+        if index:
+            frame = frame.reset_index()
+        if sheet_name not in self.sheets:
+            worksheet = self.workbook.add_worksheet(sheet_name)
+            worksheet.write_row(0, 0, [str(name) for name in frame.columns], self.header_format)
+            self.sheets[sheet_name] = worksheet
+            self.next_rows[sheet_name] = 1
+        worksheet = self.sheets[sheet_name]
+        row = self.next_rows[sheet_name]
+        if row + len(frame) > EXCEL_MAX_ROWS:
+            raise ValueError("資料列數超過 Excel 上限（1,048,576 列），請改用 CSV 格式")
+
+        # 逐段轉為 object（空值寫為空白儲存格），不為整個 frame 建立 object 複本
+        for start in range(0, len(frame), self.BLOCK_ROWS):
+            block = frame.iloc[start:start + self.BLOCK_ROWS]
+            values = block.astype(object).where(block.notna(), None)
+            for record in values.itertuples(index=False, name=None):
+                worksheet.write_row(row, 0, record)
+                row += 1
+        self.next_rows[sheet_name] = row
+
+    def close(self):
+        try:
+            self.workbook.close()
+            if self.target is not None:
+                with open(self.temp_path, "rb") as f:
+                    shutil.copyfileobj(f, self.target)
+        finally:
+            if self.temp_path is not None:
+                os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+EXCEL_MAX_ROWS = 1_048_576
+
+# --- 匯出 ---
+EXPORT_FORMATS = {
+    "xlsx": ("Excel (xlsx)", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": ("CSV", "text/csv"),
+    "parquet": ("Parquet", "application/octet-stream"),
+}
+
+def available_export_formats():
+    return [name for name in EXPORT_FORMATS if name != "parquet" or HAS_PARQUET]
+
+def export_xlsx(frame, extra_sheets=None, target=None):
+    """
+    以 constant_memory 模式寫出 xlsx：分類結果 + 選用的統計工作表（{工作表名稱: DataFrame 或 Series}，含索引）
+    target 為 None 時經由暫存檔寫出後回傳 bytes
+    """
+    buffer = io.BytesIO() if target is None else target
+    with XlsxStreamWriter(buffer) as writer:
+        writer.write_frame("分類結果", frame)
+        for sheet_name, table in (extra_sheets or {}).items():
+            if isinstance(table, pd.Series):
+                table = table.to_frame()
+            writer.write_frame(sheet_name, table, index=True)
+    return buffer.getvalue() if target is None else None
+
+def export_csv(frame, target=None):
+    """CSV（UTF-8 BOM，Excel 可直接開啟中文）"""
+    if target is None:
+        return frame.to_csv(index=False).encode("utf-8-sig")
+    frame.to_csv(target, index=False, encoding="utf-8-sig")
+
+def export_parquet(frame, target=None):
+    """Parquet；混合型別的原始欄位（如同時有數字與文字的需求數）轉為字串"""
+    frame = frame.copy(deep=False)
+    for name in frame.columns:
+        if frame[name].dtype == object and pd.api.types.infer_dtype(frame[name], skipna=True).startswith("mixed"):
+            frame[name] = frame[name].astype(str).where(frame[name].notna(), None)
+    frame.columns = [str(name) for name in frame.columns]
+    if target is None:
+        buffer = io.BytesIO()
+        frame.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+    frame.to_parquet(target, index=False)
+
+def export_frame(frame, file_format, extra_sheets=None, target=None):
+    """依格式匯出（xlsx / csv / parquet），target 為 None 時回傳 bytes"""
+    if file_format == "xlsx":
+        return export_xlsx(frame, extra_sheets, target)
+    elif file_format == "csv":
+        return export_csv(frame, target)
+    elif file_format == "parquet":
+        return export_parquet(frame, target)
+    raise ValueError(f"不支援的匯出格式：{file_format}")
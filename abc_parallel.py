@@ -0,0 +1,288 @@
+"""
+多核心平行處理：大型資料依列範圍分片，在行程池中平行分類與清理數值；ABC 分析在目前行程計算
+
+    from abc_parallel import run_analysis_parallel
+    result = run_analysis_parallel(df, rules, columns, workers=8)   # 結果與 run_analysis 完全相同
+
+分片不以 pickle 傳送整個 DataFrame：數值與字串型別的欄位以 Arrow IPC 格式放在共用記憶體，子行程直接對應讀取；
+只有型別混雜的 object 欄位（Arrow 無法表示）隨工作 pickle 傳送。子行程的計算結果直接寫入共用記憶體中的陣列。
+ABC 分析只需一次排序與分組累計（30 萬筆約 0.15 秒），拆給子行程反而增加傳送成本，因此與 run_analysis 共用 assign_abc_labels。
+"""
+import multiprocessing
+import os
+import sys
+import types
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from abc_core import (
+    ABC_THRESHOLDS,
+    RESULT_CATEGORIES,
+    AnalysisResult,
+    ClassificationMemo,
+    Diagnostics,
+    abc,
+    assign_abc_labels,
+    classify,
+    classify_columns,
+    clean_numeric_column,
+    compile_rules,
+    merge_numeric_stats,
+    record_numeric_stats,
+)
+
+try:
+    import pyarrow as pa
+    HAS_ARROW = True
+except ImportError:  # 沒有 pyarrow 時所有欄位都以 pickle 傳送
+    HAS_ARROW = False
+
+# 少於此筆數時啟動行程與搬移資料的成本高於平行的效益，直接在目前行程執行
+PARALLEL_MIN_ROWS = 200_000
+
+# 子行程內的分類備忘表：行程池持續存在，重複執行相同規則時沿用
+PROCESS_MEMO = ClassificationMemo()
+
+POOL = None
+
+def default_workers():
+    return os.cpu_count() or 1
+
+def process_pool(workers):
+    """共用的行程池（spawn，不複製伺服器行程的執行緒狀態）；工作數改變時重新建立"""
+    global POOL
+    if POOL is None or POOL._max_workers != workers:
+        if POOL is not None:
+            POOL.shutdown(wait=False)
+        POOL = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return POOL
+
+@contextmanager
+def main_module_hidden():
+    """
+    spawn 的子行程啟動時會重新執行 __main__ 模組；Streamlit 把網頁腳本安裝為 __main__（且無法使用 __main__ 保護），
+    子行程只需要本模組的函式，因此建立子行程期間暫時換成空模組
+    """
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = types.ModuleType("__main__")
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main
+
+def submit_all(pool, function, calls):
+    """送出 function(*args) 的所有工作，依送出順序回傳 futures（行程池在送出工作時才建立子行程）"""
+    with main_module_hidden():
+        return [pool.submit(function, *args) for args in calls]
+
+def shard_bounds(row_count, parts):
+    """依列範圍平均分成 parts 片，回傳 [(起始列, 結束列)]"""
+    edges = np.linspace(0, row_count, parts + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(edges[:-1], edges[1:]) if stop > start]
+
+def create_shared_array(length, dtype):
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(length * dtype.itemsize, 1))
+    return shm, np.ndarray(length, dtype=dtype, buffer=shm.buf)
+
+def attach_shared_array(spec):
+    """spec：(共用記憶體名稱, 長度, dtype)"""
+    name, length, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(length, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def release_shared(shm):
+    shm.close()
+    shm.unlink()
+
+def is_arrow_column(series):
+    """數值、布林與字串型別的欄位可無損轉為 Arrow；object 欄位（型別混雜、統計需保留原始型別）不行"""
+    if not HAS_ARROW:
+        return False
+    return series.dtype.kind in "iufb" or (series.dtype != object and pd.api.types.is_string_dtype(series.dtype))
+
+class SharedColumns:
+    """
+    交給子行程的欄位：可轉為 Arrow 的欄位寫成 Arrow IPC 檔案（每個分片一個 record batch）放在共用記憶體，
+    子行程以 load_shared_columns 直接對應讀取；其餘欄位在 shard_spec 中隨工作 pickle 傳送
+    """
+
+    def __init__(self, columns, bounds):
+        self.columns = columns
+        self.bounds = bounds
+        self.arrow_positions = [i for i, series in enumerate(columns) if is_arrow_column(series)]
+        self.shm = None
+        if self.arrow_positions:
+            names = [f"c{i}" for i in self.arrow_positions]
+            sink = pa.BufferOutputStream()
+            batches = [
+                pa.record_batch([pa.array(columns[i].iloc[start:stop], from_pandas=True) for i in self.arrow_positions], names=names)
+                for start, stop in bounds
+            ]
+            with pa.ipc.new_file(sink, batches[0].schema) as writer:
+                for batch in batches:
+                    writer.write_batch(batch)
+            buffer = sink.getvalue()
+            self.size = buffer.size
+            self.shm = shared_memory.SharedMemory(create=True, size=max(buffer.size, 1))
+            np.ndarray(buffer.size, dtype=np.uint8, buffer=self.shm.buf)[:] = np.frombuffer(buffer, dtype=np.uint8)
+
+    def shard_spec(self, index):
+        start, stop = self.bounds[index]
+        pickled = {
+            i: series.iloc[start:stop].reset_index(drop=True)
+            for i, series in enumerate(self.columns) if i not in self.arrow_positions
+        }
+        shared = (self.shm.name, self.size, index, self.arrow_positions) if self.shm is not None else None
+        return shared, pickled, len(self.columns)
+
+    def close(self):
+        if self.shm is not None:
+            release_shared(self.shm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+def load_shared_columns(spec, work):
+    """在子行程讀取分片的欄位（依原本順序的 Series 清單）並呼叫 work(columns)，結束後釋放共用記憶體的參照"""
+    shared, pickled, count = spec
+    columns = [None] * count
+    for i, series in pickled.items():
+        columns[i] = series
+    if shared is None:
+        return work(columns)
+    name, size, index, positions = shared
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        batch = pa.ipc.open_file(pa.py_buffer(shm.buf)[:size]).get_batch(index)
+        for position, column in zip(positions, batch.columns):
+            columns[position] = column.to_pandas()
+        del batch, column
+        return work(columns)
+    finally:
+        # Arrow 字串欄位直接參照共用記憶體，必須先釋放才能關閉
+        columns.clear()
+        shm.close()
+
+# --- 子行程中執行的工作 ---
+def classify_shard(spec, compiled, category_codes, output, start):
+    """分類一個分片，分類代碼寫入共用記憶體，回傳提示訊息"""
+    shm, codes = attach_shared_array(output)
+    try:
+        def work(columns):
+            diagnostics = Diagnostics()
+            labels = classify_columns(columns[0], columns[1], compiled, diagnostics, PROCESS_MEMO)
+            codes[start:start + len(labels)] = labels.map(category_codes).to_numpy(dtype=codes.dtype)
+            return diagnostics.warnings
+        return load_shared_columns(spec, work)
+    finally:
+        shm.close()
+
+def clean_shard(spec, outputs, start):
+    """清理一個分片的需求數與單價，結果寫入共用記憶體，回傳 (需求數統計, 單價統計)"""
+    attached = [attach_shared_array(output) for output in outputs]
+    try:
+        def work(columns):
+            stats = []
+            for series, (_, values) in zip(columns, attached):
+                cleaned, column_stats = clean_numeric_column(series)
+                values[start:start + len(cleaned)] = cleaned.to_numpy()
+                stats.append(column_stats)
+            return tuple(stats)
+        return load_shared_columns(spec, work)
+    finally:
+        for shm, _ in attached:
+            shm.close()
+
+# --- 對外 API ---
+def shared_spec(shm, array):
+    return shm.name, len(array), array.dtype.str
+
+def classify_parallel(df, rules, columns, diagnostics=None, workers=None, memo=None):
+    """
+    平行版的 abc_core.classify：依列範圍分片分類，結果與 classify 相同（直接修改並回傳傳入的 DataFrame）
+    memo 只用於筆數不足、改在目前行程執行時；子行程各自保留 PROCESS_MEMO
+    """
+    workers = workers or default_workers()
+    if workers <= 1 or len(df) < PARALLEL_MIN_ROWS:
+        return classify(df, rules, columns, diagnostics, memo)
+    if diagnostics is None:
+        diagnostics = Diagnostics()
+
+    compiled = compile_rules(rules)
+    category_names = RESULT_CATEGORIES + [name for name, _ in compiled if name not in RESULT_CATEGORIES]
+    category_codes = {name: code for code, name in enumerate(category_names)}
+    bounds = shard_bounds(len(df), workers)
+    with diagnostics.stage("主分類", len(df)):
+        shm, codes = create_shared_array(len(df), np.int16)
+        try:
+            with SharedColumns([df[columns.prod_col], df[columns.currency_col]], bounds) as inputs:
+                futures = submit_all(process_pool(workers), classify_shard, [
+                    (inputs.shard_spec(i), compiled, category_codes, shared_spec(shm, codes), start)
+                    for i, (start, _) in enumerate(bounds)
+                ])
+                for future in futures:
+                    for message in future.result():
+                        if message not in diagnostics.warnings:
+                            diagnostics.warn(message)
+            labels = np.array(category_names, dtype=object)[codes]
+        finally:
+            del codes
+            release_shared(shm)
+        df['分類'] = pd.Series(labels, index=df.index, dtype=object)
+    return df
+
+def abc_parallel(df, columns, diagnostics=None, workers=None, thresholds=ABC_THRESHOLDS):
+    """
+    平行版的 abc_core.abc：分片平行清理數值，ABC 分析在目前行程計算
+    新增的欄位與結果皆與 abc 相同（直接修改並回傳傳入的 DataFrame）
+    """
+    workers = workers or default_workers()
+    if workers <= 1 or len(df) < PARALLEL_MIN_ROWS:
+        return abc(df, columns, diagnostics, thresholds)
+    if diagnostics is None:
+        diagnostics = Diagnostics()
+    pool = process_pool(workers)
+    row_count = len(df)
+
+    bounds = shard_bounds(row_count, workers)
+    with diagnostics.stage("數值轉換", row_count):
+        outputs = [create_shared_array(row_count, np.float64) for _ in range(2)]
+        try:
+            with SharedColumns([df[columns.qty_col], df[columns.price_col]], bounds) as inputs:
+                specs = [shared_spec(shm, array) for shm, array in outputs]
+                futures = submit_all(pool, clean_shard, [(inputs.shard_spec(i), specs, start) for i, (start, _) in enumerate(bounds)])
+                qty_stats, price_stats = {}, {}
+                for future in futures:
+                    shard_qty_stats, shard_price_stats = future.result()
+                    qty_stats = merge_numeric_stats(qty_stats, shard_qty_stats)
+                    price_stats = merge_numeric_stats(price_stats, shard_price_stats)
+            df['需求數_清理'] = pd.Series(outputs[0][1].copy(), index=df.index)
+            df['單價_清理'] = pd.Series(outputs[1][1].copy(), index=df.index)
+        finally:
+            for shm, _ in outputs:
+                release_shared(shm)
+            del outputs
+
+    with diagnostics.stage("ABC 分析", row_count):
+        df['金額'] = df['需求數_清理'] * df['單價_清理']
+        df['累計金額'], df['累計百分比'], df['ABC類別'] = assign_abc_labels(df['分類'], df['金額'], thresholds=thresholds)
+
+    record_numeric_stats(diagnostics, qty_stats, price_stats, df['金額'])
+    return df
+
+def run_analysis_parallel(df, rules, columns, workers=None, copy=True, thresholds=ABC_THRESHOLDS):
+    """平行版的 run_analysis，回傳 AnalysisResult；結果與 run_analysis 完全相同"""
+    diagnostics = Diagnostics()
+    frame = df.copy() if copy else df
+    frame = classify_parallel(frame, rules, columns, diagnostics, workers)
+    frame = abc_parallel(frame, columns, diagnostics, workers, thresholds)
+    return AnalysisResult(frame, diagnostics)
@@ -0,0 +1,85 @@
+"""
+效能量測工具：行程記憶體高峰、各階段計時（見 abc_core.Diagnostics.stage）與單次執行的效能剖析
+
+效能剖析預設使用標準函式庫的 cProfile；若另外安裝 pyinstrument（`pip install pyinstrument`）可改用其取樣式剖析。
+"""
+import cProfile
+import io
+import marshal
+import platform
+import pstats
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows 沒有 resource 模組，記憶體高峰無法取得
+    resource = None
+
+try:
+    import pyinstrument
+    HAS_PYINSTRUMENT = True
+except ImportError:
+    HAS_PYINSTRUMENT = False
+
+def peak_rss_mb():
+    """行程記憶體高峰（MB）；無法取得時回傳 None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+def environment_info():
+    import numpy as np
+    import pandas as pd
+
+    return {
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+    }
+
+def profile_engines():
+    return ["cProfile"] + (["pyinstrument"] if HAS_PYINSTRUMENT else [])
+
+class RunProfiler:
+    """
+    單次執行的效能剖析（with 區塊內的所有呼叫）：
+        with RunProfiler("cProfile") as profiler:
+            ...
+        profiler.report_text()      # 文字摘要
+        profiler.report_file()      # (檔名, 內容 bytes, MIME)，可下載後以 snakeviz / 瀏覽器開啟
+    """
+
+    def __init__(self, engine="cProfile"):
+        self.engine = engine
+        self.profiler = pyinstrument.Profiler() if engine == "pyinstrument" else cProfile.Profile()
+
+    def __enter__(self):
+        if self.engine == "pyinstrument":
+            self.profiler.start()
+        else:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.engine == "pyinstrument":
+            self.profiler.stop()
+        else:
+            self.profiler.disable()
+        return False
+
+    def report_text(self, limit=30):
+        if self.engine == "pyinstrument":
+            return self.profiler.output_text()
+        output = io.StringIO()
+        pstats.Stats(self.profiler, stream=output).sort_stats("cumulative").print_stats(limit)
+        return output.getvalue()
+
+    def report_file(self):
+        if self.engine == "pyinstrument":
+            return "profile.html", self.profiler.output_html().encode("utf-8"), "text/html"
+        # pstats 的 marshal 格式，可用 `python -m pstats profile.prof` 或 snakeviz 開啟
+        self.profiler.create_stats()
+        return "profile.prof", marshal.dumps(self.profiler.stats), "application/octet-stream"